@@ -7,19 +7,17 @@ aggregate RSS, CDF and Atom feeds taken from elsewhere into a single,
 combined feed.
 """
 
-import dbhash
 from hashlib import md5
 import logging
 import os
 import re
-import sgmllib
 import time
 from xml.sax.saxutils import escape
 
 import feedparser
 import sanitize
 
-from . import cache, render
+from . import cache, model, render
 from .constants import __version__, TIMEFMT_ISO, TIMEFMT_822, VERSION
 
 log = logging.getLogger(__name__)
@@ -33,9 +31,27 @@ CACHE_DIRECTORY = "cache"
 # Default number of items to display from a new feed
 NEW_FEED_ITEMS = 10
 
+# Default cache retention, zero keeps items for as long as the feed does
+CACHE_MAX_ITEMS = 0
+CACHE_MAX_AGE = 0
+CACHE_COMMIT_EVERY = 0
+CACHE_OPEN_FILES = 256
+LOAD_PROCESSES = 1
+RENDER_PROCESSES = 1
+
+# Snapshot of the gathered template model, kept in the cache directory
+SNAPSHOT_FILENAME = ".snapshot"
+
+# Record of the snapshot each template was last rendered from
+RECORD_FILENAME = ".rendered"
+
+# Compiled templates, kept in the cache directory
+COMPILED_DIRECTORY = ".compiled"
+
 
 # Defaults for the template file config sections
 ENCODING = "utf-8"
+PRECOMPRESS = 0
 ITEMS_PER_PAGE = 60
 DAYS_PER_PAGE = 0
 OUTPUT_DIR = "output"
@@ -45,34 +61,28 @@ ACTIVITY_THRESHOLD = 0
 DATE_KEYS = ("updated", "modified", "published", "issued", "created")
 
 try:
-    from multiprocessing.pool import ThreadPool
+    from multiprocessing.pool import Pool, ThreadPool
 except ImportError:
-    ThreadPool = None
-
-class stripHtml(sgmllib.SGMLParser):
-    """remove all tags from the data"""
-    def __init__(self, data):
-        sgmllib.SGMLParser.__init__(self)
-        self.result=''
-        self.feed(data)
-        self.close()
-    def handle_data(self, data):
-        if data: self.result+=data
+    Pool = ThreadPool = None
 
 def template_info(item, date_format):
-    """Produce a dictionary of template information."""
-    info = {}
+    """Produce a dictionary of template information.
+
+    Dates are only formatted, compressed values decompressed and the
+    title stripped of HTML if a template reads them.
+    """
+    info = model.TemplateInfo()
     for key in item.keys():
-        if item.key_type(key) == item.DATE:
-            date = item.get_as_date(key)
-            info[key] = time.strftime(date_format, date)
-            info[key + "_iso"] = time.strftime(TIMEFMT_ISO, date)
-            info[key + "_822"] = time.strftime(TIMEFMT_822, date)
+        if key == 'title_plain':
+            continue
+        elif item.key_type(key) == item.DATE:
+            info.defer_date(key, item.get_as_timestamp(key), date_format)
+        elif item.is_compressed(key):
+            info.defer(key, item.get, key)
         else:
             info[key] = item[key]
     if 'title' in item.keys():
-        info['title_plain'] = stripHtml(info['title']).result
-
+        info.defer('title_plain', item.get, 'title_plain')
     return info
 
 
@@ -123,6 +133,14 @@ class Planet(object):
         new_feed_items  Number of items to display from a new feed.
         filter          A regular expression that articles must match.
         exclude         A regular expression that articles must not match.
+        cache_max_items Most items to keep in each channel's cache.
+        cache_max_age   Days to keep items in each channel's cache.
+        cache_keep_items
+                        Newest items of the planet that are always kept.
+        cache_keep_ids  Ids of those items, see keep_newest_items().
+        blobs           BlobStore shared by the channels, or None.
+        writer          GroupWriter committing the caches, or None.
+        handles         HandlePool of open cache files, or None.
     """
     def __init__(self, config):
         self.config = config
@@ -134,6 +152,13 @@ class Planet(object):
         self.new_feed_items = NEW_FEED_ITEMS
         self.filter = None
         self.exclude = None
+        self.cache_max_items = CACHE_MAX_ITEMS
+        self.cache_max_age = CACHE_MAX_AGE
+        self.cache_keep_items = ITEMS_PER_PAGE
+        self.cache_keep_ids = set()
+        self.blobs = None
+        self.writer = None
+        self.handles = None
 
     def tmpl_config_get(self, option, default=None, raw=0):
         """Get a template value from the configuration, with a default."""
@@ -155,13 +180,13 @@ class Planet(object):
         channels = {}
         channels_list = []
         for channel in self.channels(hidden=True):
+            latest = channel.get("latest_date")
             channels[channel] = template_info(channel, date_format)
             channels_list.append(channels[channel])
 
             # identify inactive feeds
             if activity_horizon:
-                latest = channel.items(sort=True)
-                if len(latest)==0 or latest[0].date < activity_horizon:
+                if latest is None or latest < activity_horizon:
                     channels[channel]["message"] = \
                         "no activity in %d days" % activity_threshold
 
@@ -197,9 +222,7 @@ class Planet(object):
                                    max_days=days_per_page,
                                    channels=channel_list):
             item_info = template_info(newsitem, date_format)
-            chan_info = channels[newsitem._channel]
-            for k, v in chan_info.items():
-                item_info["channel_" + k] = v
+            item_info.chain("channel_", channels[newsitem._channel])
     
             # Check for the start of a new day
             if prev_date[:3] != newsitem.date[:3]:
@@ -217,12 +240,204 @@ class Planet(object):
 
         return items_list
 
-    def run(self, planet_name, planet_link, template_files, offline=False):
+    def gather_model(self, template_files):
+        """Return the serial, channels_list and items_list for the templates.
 
-        # Create a planet
-        log.info("Loading cached data")
+        Reuses the snapshot in the cache directory if the config and the
+        channel caches it was gathered from haven't changed, nor has the
+        status of the subscribed channels.  If no channels are subscribed
+        (a render-only run) the snapshot is used as long as the caches
+        are unchanged, and the channels are only loaded if it can't be.
+        Otherwise the channels are gathered and a new snapshot is saved.
+        The serial identifies the snapshot, it is None if none was saved.
+        """
+        snapshot_filename = os.path.join(self.cache_directory,
+                                         SNAPSHOT_FILENAME)
+        fingerprint = self.snapshot_fingerprint(template_files)
+        state = None
+        if self._channels:
+            state = self.snapshot_state()
+        snapshot = model.load_snapshot(snapshot_filename, fingerprint, state)
+        if snapshot is not None:
+            log.info("Using the snapshot of unchanged channels")
+            return snapshot
+
+        if not self._channels:
+            self.load_channels(self.channel_urls(template_files),
+                               int(self.tmpl_config_get(
+                                   "load_processes", LOAD_PROCESSES)))
+        if not os.path.isdir(self.cache_directory):
+            os.makedirs(self.cache_directory)
+        channels, channels_list = self.gather_channel_info()
+        items_list = self.gather_items_info(channels)
+
+        # The snapshot holds all but the dates worked out anyway, so do
+        # that now and keep the values derived from the channels and
+        # items in their caches, for the runs that can't use it.  That
+        # changes the caches the snapshot was fingerprinted from.
+        for info in channels_list + items_list:
+            info.compute_deferred()
+        if self.write_derived():
+            fingerprint = self.snapshot_fingerprint(template_files)
+        serial = None
+        try:
+            serial = model.save_snapshot(snapshot_filename, fingerprint,
+                                         channels_list, items_list,
+                                         self.snapshot_expires(),
+                                         self.snapshot_state())
+        except Exception:
+            log.exception("Could not save the snapshot")
+        return serial, channels_list, items_list
+
+    def write_derived(self):
+        """Write new derived values to the channel caches.
+
+        Returns whether there were any.
+        """
+        written = False
+        for channel in self._channels:
+            written = channel.write_derived() or written
+        if written and self.writer is not None:
+            self.writer.commit()
+        return written
+
+    def snapshot_fingerprint(self, template_files):
+        """Return a digest of everything the gathered model depends on."""
+        inputs = [VERSION]
+        for section in sorted(self.config.sections()):
+            inputs.append((section, sorted(self.config.items(section,
+                                                             raw=True))))
+        for url in self.channel_urls(template_files):
+            try:
+                stat = os.stat(cache.filename(self.cache_directory, url))
+            except OSError:
+                inputs.append((url, None))
+            else:
+                inputs.append((url, stat.st_mtime, stat.st_size))
+        return md5(repr(inputs)).hexdigest()
+
+    def snapshot_state(self):
+        """Return the channel status that isn't kept in their caches.
+
+        Only error statuses are shown, so the others count as the same.
+        """
+        state = []
+        for channel in self._channels:
+            status = channel.url_status
+            if not status or int(status) < 400:
+                status = None
+            state.append((channel.configured_url, status))
+        return sorted(state)
+
+    def snapshot_expires(self):
+        """Return when a channel next becomes inactive, or None.
+
+        The "no activity" messages depend on the time, so a snapshot
+        of them goes out of date when another channel crosses the
+        activity threshold.
+        """
+        activity_threshold = int(self.tmpl_config_get(
+            "activity_threshold", ACTIVITY_THRESHOLD))
+        if not activity_threshold:
+            return None
+        now = time.time()
+        expires = None
+        for channel in self.channels(hidden=True):
+            latest = channel.get("latest_date")
+            if latest is None:
+                continue
+            inactive = cache.timestamp(latest) + 86400 * activity_threshold
+            if inactive > now and (expires is None or inactive < expires):
+                expires = inactive
+        return expires
+
+    def configure_cache(self):
+        """Read the cache location and retention policy from the config."""
         if self.config.has_option("Planet", "cache_directory"):
             self.cache_directory = self.config.get("Planet", "cache_directory")
+        self.cache_max_items = int(self.tmpl_config_get(
+            "cache_max_items", CACHE_MAX_ITEMS))
+        self.cache_max_age = float(self.tmpl_config_get(
+            "cache_max_age", CACHE_MAX_AGE))
+        self.cache_keep_items = int(self.tmpl_config_get(
+            "items_per_page", ITEMS_PER_PAGE))
+
+        # Finish writing any commit an earlier run was cut short in
+        if os.path.isdir(self.cache_directory):
+            recovered = cache.recover(self.cache_directory)
+            if recovered:
+                log.warning("Finished %d interrupted cache commits",
+                            recovered)
+
+        # In group commit mode the caches are committed together
+        # by one writer, rather than each channel syncing its own.
+        if self.writer is None and \
+               self.config.has_option("Planet", "cache_group_commit") and \
+               self.config.getboolean("Planet", "cache_group_commit"):
+            self.writer = cache.GroupWriter(int(self.tmpl_config_get(
+                "cache_commit_every", CACHE_COMMIT_EVERY)))
+
+        # Keep only so many cache files open at once
+        open_files = int(self.tmpl_config_get(
+            "cache_open_files", CACHE_OPEN_FILES))
+        if self.handles is None and open_files > 0:
+            self.handles = cache.HandlePool(open_files)
+
+        # Once there is a blob store the caches refer to it,
+        # so keep using it even if the option is turned off.
+        use_blobs = self.config.has_option("Planet", "cache_blobs") and \
+            self.config.getboolean("Planet", "cache_blobs")
+        if self.blobs is None and (use_blobs or os.path.isfile(
+                os.path.join(self.cache_directory, cache.BlobStore.FILENAME))):
+            if not os.path.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            self.blobs = cache.BlobStore(self.cache_directory, self.writer)
+
+    def channel_urls(self, template_files=()):
+        """Return the feed urls of the channels in the config."""
+        return [url for url in self.config.sections()
+                if url != 'Planet' and url not in template_files]
+
+    def load_channels(self, urls=None, processes=1, read_only=False):
+        """Create and subscribe the channels for urls from their caches.
+
+        Loads every channel in the config if urls is not given.  With
+        more than one process, the caches are read and parsed by a pool
+        of worker processes, and only building the channels from what
+        they read is left to this one.  If read_only, the caches are
+        only ever opened for reading, and channels that have none are
+        left out rather than given an empty one.
+        """
+        if urls is None:
+            urls = self.channel_urls()
+        filenames = [cache.filename(self.cache_directory, url)
+                     for url in urls]
+        records = [None] * len(urls)
+        if processes > 1 and Pool is None:
+            log.warning('Could not import multiprocessing.pool, '
+                        'cannot use parallel cache loading.')
+            processes = 1
+        if processes > 1:
+            log.debug('Loading caches using %s processes', processes)
+            pool = Pool(processes)
+            try:
+                records = pool.map(cache.read_records, filenames)
+            finally:
+                pool.close()
+                pool.join()
+        elif read_only:
+            records = [cache.read_records(f) for f in filenames]
+        for url, channel_records in zip(urls, records):
+            if read_only and channel_records is None:
+                continue
+            self.subscribe(Channel(self, url, channel_records))
+
+    def run(self, planet_name, planet_link, template_files, offline=False,
+            render_only=False):
+
+        # Create a planet
+        log.info("Loading cached data")
+        self.configure_cache()
         if self.config.has_option("Planet", "new_feed_items"):
             self.new_feed_items  = int(self.config.get("Planet", "new_feed_items"))
         self.user_agent = "%s +%s %s" % (planet_name, planet_link,
@@ -230,6 +445,18 @@ class Planet(object):
         if self.config.has_option("Planet", "filter"):
             self.filter = self.config.get("Planet", "filter")
 
+        # The other configuration blocks are channels to subscribe to
+        urls = self.channel_urls(template_files)
+
+        if render_only:
+            # Channels are only loaded if there is no usable snapshot
+            return
+        self.load_channels(urls, int(self.tmpl_config_get(
+            "load_processes", LOAD_PROCESSES)))
+        if offline:
+            return
+        self.keep_newest_items()
+
         threadcount = int(self.tmpl_config_get('threads', 1))
         mapper = map
         if threadcount > 1:
@@ -241,21 +468,40 @@ class Planet(object):
                 pool = ThreadPool(threadcount)
                 mapper = pool.map
 
-        # The other configuration blocks are channels to subscribe to
-        urls = [url for url in self.config.sections()
-                if url != 'Planet' and url not in template_files]
-
-        def update_channel(feed_url):
-            # Create a channel, configure it and subscribe it
-            channel = Channel(self, feed_url)
-            self.subscribe(channel)
+        def update_channel(channel):
             try:
-                if not offline and not channel.url_status == '410':
+                if not channel.url_status == '410':
                     channel.update()
             except Exception:
                 log.exception("Update of <%s> failed", channel.url)
 
-        mapper(update_channel, urls)
+        mapper(update_channel, list(self._channels))
+        log.info("%d of %d channels changed",
+                 len([c for c in self._channels if c._cache.changes]),
+                 len(self._channels))
+
+        if self.writer is not None:
+            self.writer.commit()
+            log.debug("Committed %d cache changes in %d commits",
+                      self.writer.changes, self.writer.commits)
+        if self.handles is not None:
+            log.debug("Opened cache files %d times (%d reopens), "
+                      "at most %d at once", self.handles.opens,
+                      self.handles.reopens, self.handles.peak)
+
+    def keep_newest_items(self):
+        """Note the items that expiring items must leave in the caches.
+
+        They are the newest cache_keep_items items of the whole planet,
+        the ones a page would show, so the page can still be filled
+        however few items the retention policy leaves otherwise.  Their
+        ids are kept in cache_keep_ids, and need working out before any
+        channel writes its cache.
+        """
+        self.cache_keep_ids = set()
+        if self.cache_max_items or self.cache_max_age:
+            self.cache_keep_ids = set(
+                item.id for item in self.items(max_items=self.cache_keep_items))
 
     def generate_all_files(self, template_files, planet_kwargs):
 
@@ -263,22 +509,111 @@ class Planet(object):
         output_dir = self.tmpl_config_get("output_dir", OUTPUT_DIR)
         date_format = self.tmpl_config_get("date_format", DATE_FORMAT, raw=1)
         encoding = self.tmpl_config_get("encoding", ENCODING)
+        precompress = bool(int(self.tmpl_config_get("precompress",
+                                                    PRECOMPRESS)))
         # Gather information
-        channels, channels_list = self.gather_channel_info()
-        items_list = self.gather_items_info(channels)
-
+        serial, channels_list, items_list = self.gather_model(template_files)
+
+        # Templates already rendered from the same snapshot are only
+        # rendered again if they show the time they were rendered at.
+        # The render key doesn't cover included templates, uses_time()
+        # counts any template that includes another as showing the time.
+        record_filename = os.path.join(self.cache_directory, RECORD_FILENAME)
+        old_record = render.load_record(record_filename)
+        record = {}
+        search_path = []
+        for template_file in template_files:
+            directory = os.path.dirname(template_file) or os.curdir
+            if directory not in search_path:
+                search_path.append(directory)
+        compiled_directory = os.path.join(self.cache_directory,
+                                          COMPILED_DIRECTORY)
+        keys = {}
         for template_file in template_files:
+            output_file = os.path.join(output_dir,
+                                       render.output_name(template_file))
+            key = render.render_key(template_file, output_file, serial,
+                                    precompress)
+            if key is not None and old_record.get(template_file) == key \
+                   and os.path.isfile(output_file) \
+                   and not render.uses_time(template_file):
+                log.info("Skipping %s, nothing changed", template_file)
+                record[template_file] = key
+            else:
+                keys[template_file] = key
+        to_render = [template_file for template_file in template_files
+                     if template_file in keys]
+
+        # Jinja templates share one unicode view of the model
+        unicode_lists = None
+        if any(template_file.endswith(render.JINJA_EXTENSIONS)
+               for template_file in to_render):
+            unicode_lists = model.unicode_lists(channels_list, items_list)
+        render_args = (output_dir, date_format, encoding, channels_list,
+                       items_list, planet_kwargs, search_path,
+                       compiled_directory, unicode_lists, precompress)
+        processes = min(int(self.tmpl_config_get("render_processes",
+                                                 RENDER_PROCESSES)),
+                        len(to_render))
+        if processes > 1 and Pool is None:
+            log.warning('Could not import multiprocessing.pool, '
+                        'cannot use parallel rendering.')
+            processes = 1
+        if processes > 1:
+            log.debug('Rendering templates using %s processes', processes)
+            pool = Pool(processes, render.init_worker, (render_args,))
             try:
-                render.render_template(
-                    template_file,
-                    output_dir,
-                    date_format,
-                    encoding,
-                    channels_list,
-                    items_list,
-                    planet_kwargs)
-            except Exception:
-                log.exception('Write failed for %s', template_file)
+                rendered = pool.map(render.render_in_worker, to_render)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            rendered = [render.try_render_template(template_file, *render_args)
+                        for template_file in to_render]
+        for template_file, ok in zip(to_render, rendered):
+            if ok:
+                record[template_file] = keys[template_file]
+
+        try:
+            render.save_record(record_filename, record)
+        except Exception:
+            log.exception("Could not save the render record")
+
+    def compact_cache(self):
+        """Rewrite every channel's cache file to drop dead space.
+
+        Berkeley DB files never shrink when keys are deleted, so caches
+        that have expired a lot of items keep growing and get slower to
+        read.  Must not be run at the same time as an update.
+
+        Blobs that no channel refers to any more are removed first.
+
+        Returns a list of (filename, size_before, size_after,
+        load_before, load_after) tuples, with load times in seconds.
+        """
+        self.configure_cache()
+        filenames = [cache.filename(self.cache_directory, url)
+                     for url in self.channel_urls()]
+        filenames = [f for f in filenames if os.path.isfile(f)]
+
+        if self.blobs is not None:
+            referenced = set()
+            for filename in filenames:
+                referenced.update(cache.blob_references(filename))
+            removed = self.blobs.collect(referenced)
+            log.info("Removed %d unused blobs", removed)
+            filenames.append(self.blobs.filename)
+            self.blobs.close()
+            self.blobs = None
+
+        results = []
+        for filename in filenames:
+            load_before = cache.load_time(filename)
+            size_before, size_after = cache.compact(filename)
+            load_after = cache.load_time(filename)
+            results.append((filename, size_before, size_after,
+                            load_before, load_after))
+        return results
 
     def channels(self, hidden=False, sort=True):
         """Return the list of channels."""
@@ -422,6 +757,7 @@ class Channel(cache.CachedInfo):
 
         updated         Correct UTC-Normalised update time of the feed.
         last_updated    Correct UTC-Normalised time the feed was last updated.
+        latest_date     Date of the newest item that isn't hidden, or None.
 
         id              An identifier the feed claims is unique (*).
         title           One-line title (*).
@@ -460,17 +796,22 @@ class Channel(cache.CachedInfo):
     IGNORE_KEYS = ("links", "contributors", "textinput", "cloud", "categories",
                    "url", "href", "url_etag", "url_modified", "tags", "itunes_explicit")
 
-    def __init__(self, planet, url):
+    __slots__ = ("_items", "_planet", "_expired", "_derived")
+
+    def __init__(self, planet, url, records=None):
         if not os.path.isdir(planet.cache_directory):
             os.makedirs(planet.cache_directory)
         cache_filename = cache.filename(planet.cache_directory, url)
-        cache_file = dbhash.open(cache_filename, "c", 0666)
+        cache_file = cache.CacheFile(cache_filename,
+                                     getattr(planet, "writer", None),
+                                     getattr(planet, "handles", None))
 
         cache.CachedInfo.__init__(self, cache_file, url, root=1)
 
         self._items = {}
         self._planet = planet
         self._expired = []
+        self._derived = []
         self.url = url
         # retain the original URL for error reporting
         self.configured_url = url
@@ -483,8 +824,13 @@ class Channel(cache.CachedInfo):
         self.filter = None
         self.exclude = None
         self.next_order = "0"
-        self.cache_read()
-        self.cache_read_entries()
+        if records is None:
+            self.cache_read()
+            self.cache_read_entries()
+        else:
+            fields, entries = records
+            self.cache_load(fields)
+            self.cache_load_entries(entries)
 
         if planet.config.has_section(url):
             for option in planet.config.options(url):
@@ -529,19 +875,125 @@ class Channel(cache.CachedInfo):
             item = NewsItem(self, key)
             self._items[key] = item
 
+    def cache_load_entries(self, entries):
+        """Load entries, as returned by cache.read_records()."""
+        for key, fields in entries:
+            if self.has_key(key): continue
+
+            item = NewsItem(self, key, fields)
+            self._items[key] = item
+
     def cache_basename(self):
         return cache.filename('',self._id)
 
+    def blob_store(self):
+        """Return the planet's BlobStore, or None if there is none."""
+        return getattr(self._planet, "blobs", None)
+
+    def sanitize(self, value):
+        """Return value with unsafe HTML removed.
+
+        If there is a blob store, earlier results for the same long
+        content (from any channel) are reused.
+        """
+        blobs = self.blob_store()
+        if blobs is None:
+            return sanitize.HTML(value)
+        return blobs.sanitize(value, sanitize.HTML)
+
     def cache_write(self, sync=1):
         """Write channel and item information to the cache."""
+        self.expire_items()
+        # Work out latest_date if the cache predates it
+        self.get("latest_date")
         for item in self._items.values():
             item.cache_write(sync=0)
         for item in self._expired:
             item.cache_clear(sync=0)
+        # Blobs go to disk before the references to them
+        blobs = self.blob_store()
+        if sync and blobs is not None:
+            blobs.sync()
         cache.CachedInfo.cache_write(self, sync)
 
         self._expired = []
 
+    def derived_changed(self):
+        """Note that the channel has a new derived value to write."""
+        self._derived.append(self)
+
+    def write_derived(self):
+        """Write the channel and items with new derived values.
+
+        Only their own records are written, and what they already had
+        is left alone.  Returns whether there were any.
+        """
+        if not self._derived:
+            return False
+        for info in self._derived:
+            cache.CachedInfo.cache_write(info, sync=0)
+        self._derived = []
+        self._cache.sync()
+        return True
+
+    def expire_items(self):
+        """Expire items that fall outside the planet's retention policy.
+
+        Items beyond the newest Planet.cache_max_items, or older than
+        Planet.cache_max_age days, are removed from the cache, except
+        for those in Planet.cache_keep_ids, the newest of the planet.
+        """
+        max_items = self._planet.cache_max_items
+        max_age = self._planet.cache_max_age
+        if not max_items and not max_age:
+            return
+
+        keep_ids = self._planet.cache_keep_ids
+        horizon = max_age and time.time() - max_age * 86400
+
+        for index, item in enumerate(self.items(hidden=True, sort=True)):
+            if item.id in keep_ids:
+                continue
+            if (max_items and index >= max_items) or \
+                   (horizon and cache.timestamp(item.date) < horizon):
+                del(self._items[item.id])
+                self._expired.append(item)
+                self._item_date_changed(item, item.date, None)
+                log.debug("Removed retired item <%s>", item.id)
+
+    def get_latest_date(self, key):
+        """Return the date of the newest item that isn't hidden, or None.
+
+        It's cached with the channel and kept up to date as items are
+        added, updated and removed, so it only has to be worked out from
+        all the items when the newest one goes or the cache predates it.
+        """
+        if not self.has_key(key):
+            latest = self.items(sort=True)
+            if latest:
+                self.set_as_date(key, latest[0].date)
+            else:
+                self.set_as_null(key, None)
+        if self.key_type(key) == self.NULL:
+            return None
+        return self.get_as_date(key)
+
+    def _item_date_changed(self, item, old_date, new_date):
+        """Keep latest_date up to date when the date of item changes.
+
+        old_date is None for an item that was just added, and new_date
+        None for one that was just removed.  Hidden items don't count.
+        """
+        if not self.has_key("latest_date") or item.has_key("hidden"):
+            return
+        latest = self.get("latest_date")
+        if old_date is not None and old_date == latest and \
+               (new_date is None or new_date < old_date):
+            # Any of the other items may be the newest now
+            self.del_key("latest_date")
+        elif new_date is not None and (latest is None or new_date > latest):
+            self.set_as_date("latest_date", new_date)
+
     def feed_information(self):
         """
         Returns a description string for the feed embedded in this channel.
@@ -697,7 +1149,7 @@ class Channel(cache.CachedInfo):
                     detail = key + '_detail'
                     if feed.has_key(detail) and feed[detail].has_key('type'):
                         if feed[detail].type == 'text/html':
-                            feed[key] = sanitize.HTML(feed[key])
+                            feed[key] = self.sanitize(feed[key])
                         elif feed[detail].type == 'text/plain':
                             feed[key] = escape(feed[key])
                     self.set_as_string(key, feed[key])
@@ -747,10 +1199,12 @@ class Channel(cache.CachedInfo):
             # Create the item if necessary and update
             if self.has_item(entry_id):
                 item = self._items[entry_id]
+                old_date = item.date
             else:
                 item = NewsItem(self, entry_id)
                 self._items[entry_id] = item
                 new_items.append(item)
+                old_date = None
             item.update(entry)
             feed_items.append(entry_id)
 
@@ -759,6 +1213,7 @@ class Channel(cache.CachedInfo):
                    and len(feed_items) > self._planet.new_feed_items:
                 item.hidden = "yes"
                 log.debug("Marked <%s> as hidden (new feed)", entry_id)
+            self._item_date_changed(item, old_date, item.date)
 
         # Assign order numbers in reverse
         new_items.reverse()
@@ -776,6 +1231,7 @@ class Channel(cache.CachedInfo):
             elif item._channel.url_status != '226':
                 del(self._items[item.id])
                 self._expired.append(item)
+                self._item_date_changed(item, item.date, None)
                 log.debug("Removed expired or replaced item <%s>", item.id)
 
     def get_name(self, _):
@@ -786,6 +1242,13 @@ class Channel(cache.CachedInfo):
 
         return ""
 
+    def get_title_plain(self, key):
+        """Return the title with the HTML removed.
+
+        It is kept in the cache, until the title changes.
+        """
+        return self.get_derived(key, "title", model.plain_text)
+
 class NewsItem(cache.CachedInfo):
     """An item of news.
 
@@ -827,7 +1290,9 @@ class NewsItem(cache.CachedInfo):
     IGNORE_KEYS = ("categories", "contributors", "enclosures", "links",
                    "guidislink", "date", "tags")
 
-    def __init__(self, channel, id_):
+    __slots__ = ("_channel",)
+
+    def __init__(self, channel, id_, fields=None):
         cache.CachedInfo.__init__(self, channel._cache, id_)
 
         self._channel = channel
@@ -836,7 +1301,14 @@ class NewsItem(cache.CachedInfo):
         self.date = None
         self.order = None
         self.content = None
-        self.cache_read()
+        if fields is None:
+            self.cache_read()
+        else:
+            self.cache_load(fields)
+
+    def blob_store(self):
+        """Return the planet's BlobStore, or None if there is none."""
+        return self._channel.blob_store()
 
     def update(self, entry):
         """Update the item from the feedparser entry given."""
@@ -876,7 +1348,7 @@ class NewsItem(cache.CachedInfo):
                 value = ""
                 for item in entry[key]:
                     if item.type == 'text/html':
-                        item.value = sanitize.HTML(item.value)
+                        item.value = self._channel.sanitize(item.value)
                     elif item.type == 'text/plain':
                         item.value = escape(item.value)
                     if item.has_key('language') and item.language and \
@@ -892,7 +1364,7 @@ class NewsItem(cache.CachedInfo):
                     if entry.has_key(detail):
                         if entry[detail].has_key('type'):
                             if entry[detail].type == 'text/html':
-                                entry[key] = sanitize.HTML(entry[key])
+                                entry[key] = self._channel.sanitize(entry[key])
                             elif entry[detail].type == 'text/plain':
                                 entry[key] = escape(entry[key])
                     self.set_as_string(key, entry[key])
@@ -937,6 +1409,10 @@ class NewsItem(cache.CachedInfo):
         self.set_as_date(key, date)
         return date
 
+    def derived_changed(self):
+        """Note that the item has a new derived value to write."""
+        self._channel._derived.append(self)
+
     def get_content(self, _):
         """Return the key containing the content."""
         for key in ("content", "tagline", "summary"):
@@ -944,3 +1420,10 @@ class NewsItem(cache.CachedInfo):
                 return self.get_as_string(key)
 
         return ""
+
+    def get_title_plain(self, key):
+        """Return the title with the HTML removed.
+
+        It is kept in the cache, until the title changes.
+        """
+        return self.get_derived(key, "title", model.plain_text)
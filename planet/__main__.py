@@ -54,15 +54,40 @@ def set_locale(localestr):
         sys.exit(5)
 
 
-def main():
+def compact(config):
+    """Compacts every channel cache and reports the space reclaimed."""
+    my_planet = planet.Planet(config)
+    results = my_planet.compact_cache()
+    total_before = total_after = load_before = load_after = 0
+    for filename, size_before, size_after, load1, load2 in results:
+        log.info("Compacted %s from %d to %d bytes",
+                 filename, size_before, size_after)
+        total_before += size_before
+        total_after += size_after
+        load_before += load1
+        load_after += load2
+    print "Compacted %d cache files from %d to %d bytes (%d reclaimed)." % (
+        len(results), total_before, total_after, total_before - total_after)
+    print "Load time went from %.3fs to %.3fs." % (load_before, load_after)
+
+
+def main(argv=None):
     starttime = time.clock()
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='DEBUG level logging during update.')
     parser.add_argument('-o', '--offline', action='store_true',
                         help='Update the Planet from the cache only.')
+    parser.add_argument('--render-only', action='store_true',
+                        help='Only render the templates, from the data '
+                             'gathered last time if the cache is unchanged.')
+    parser.add_argument('command', nargs='?', default='update',
+                        choices=('update', 'compact'),
+                        help="'update' (the default) updates the Planet, "
+                             "'compact' rewrites the cache files "
+                             "to reclaim space.")
     parser.add_argument('config_file', help='Path to configuration ini file.')
-    opts = parser.parse_args()
+    opts = parser.parse_args(argv)
 
     config = read_config(opts.config_file)
 
@@ -74,6 +99,10 @@ def main():
         log_level = logging.WARN
     logging.basicConfig(level=logging.getLevelName(log_level))
 
+    if opts.command == 'compact':
+        compact(config)
+        return
+
     # Read the [Planet] config section
     planet_options = dict(config.items('Planet'))
 
@@ -93,7 +122,7 @@ def main():
                          % feed_timeout)
         sys.exit(6)
 
-    if not opts.offline:
+    if not (opts.offline or opts.render_only):
         socket.setdefaulttimeout(feed_timeout)
         log.debug("Socket timeout set to %d seconds", feed_timeout)
 
@@ -104,7 +133,8 @@ def main():
         planet_options['template_files'])
 
     my_planet = planet.Planet(config)
-    my_planet.run(planet_name, planet_link, template_files, opts.offline)
+    my_planet.run(planet_name, planet_link, template_files, opts.offline,
+                  opts.render_only)
 
     my_planet.generate_all_files(template_files, planet_options)
     duration = time.clock() - starttime
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Benchmarks for Planet internals.
+
+Run all of them with ``python -m planet.benchmarks``,
+or name the ones you want: ``python -m planet.benchmarks item_memory``.
+Each benchmark builds its own synthetic data in a temporary directory,
+so no feeds are fetched and no existing cache is touched.
+"""
+
+import ConfigParser
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import planet
+from planet import htmltmpl
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """Register ``func`` as a benchmark."""
+    BENCHMARKS.append(func)
+    return func
+
+
+class BenchPlanet(object):
+    """Just enough of a Planet to create channels from."""
+
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+        self.config = ConfigParser.ConfigParser()
+
+
+def make_channel(bench_planet, url, count, content_size=2000):
+    """Create a channel on ``bench_planet`` with ``count`` synthetic items."""
+    channel = planet.Channel(bench_planet, url)
+    channel.name = "Channel %s" % url
+    channel.updated = time.gmtime()
+    base = time.time() - count * 3600
+    for i in range(count):
+        item = planet.NewsItem(channel, "%s/%d" % (url, i))
+        date = time.gmtime(base + i * 3600)
+        item.set_as_string("title", "Item <em>%d</em> &amp; friends" % i)
+        item.set_as_string("link", "%s/%d" % (url, i))
+        item.set_as_string("author_name", "Author %d" % (i % 7))
+        item.set_as_string("summary", "<p>%s</p>" % ("s" * (content_size // 4)))
+        item.set_as_string("content", "<p>%s</p>" % ("c" * content_size))
+        item.set_as_date("published", date)
+        item.set_as_date("updated", date)
+        item.get_date("date")
+        item.order = str(i)
+        channel._items[item.id] = item
+    return channel
+
+
+def deep_sizeof(obj, seen=None):
+    """Return the size in bytes of ``obj`` and everything it refers to.
+
+    Objects are only counted once, so pass the same ``seen`` set
+    to measure several objects that share data.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        # Not obj.iteritems(), which would compute deferred TemplateInfo values
+        for k, v in dict.iteritems(obj):
+            size += deep_sizeof(k, seen) + deep_sizeof(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += deep_sizeof(v, seen)
+    for cls in type(obj).__mro__:
+        for slot in getattr(cls, "__slots__", ()):
+            if hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+    if hasattr(obj, "__dict__"):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+
+@benchmark
+def item_memory(count=2000):
+    """Memory used per cached NewsItem, with and without content."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        channel = make_channel(BenchPlanet(tmpdir), "http://bench/memory", count)
+        items = channel._items.values()
+        # Don't charge the items for the channel, its cache handle
+        # or the layouts of field names they all share.
+        seen = set([id(channel), id(channel._cache)])
+        seen.update(id(item._layout) for item in items)
+        total = sum(deep_sizeof(item, set(seen)) for item in items)
+        # The strings as held, which for long ones is compressed
+        payload = sum(sys.getsizeof(item._values[item._index(key) * 2 + 1])
+                      for item in items for key in item.keys()
+                      if item.key_type(key) == item.STRING)
+        print "item_memory: %d items, %d fields each" % (
+            len(items), len(items[0].keys()))
+        print "  total per item:    %8.0f bytes" % (float(total) / len(items))
+        print "  overhead per item: %8.0f bytes" % (
+            float(total - payload) / len(items))
+        channel._cache.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def template_info(count=2000):
+    """Time and memory taken to build the template dicts of items."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        channel = make_channel(BenchPlanet(tmpdir), "http://bench/info", count)
+        items = channel._items.values()
+        start = time.time()
+        infos = [planet.template_info(item, planet.DATE_FORMAT)
+                 for item in items]
+        elapsed = time.time() - start
+        # Count the dicts themselves, not the item values
+        # or the date key names they share
+        seen = set([id(channel)])
+        for keys in planet.model._date_keys.values():
+            seen.update(id(obj) for obj in (keys,) + keys)
+        for item in items:
+            seen.add(id(item))
+            for key in item.keys():
+                seen.add(id(item._values[item._index(key) * 2 + 1]))
+        size = sum(deep_sizeof(info, set(seen)) for info in infos)
+        print "template_info: %d items" % len(items)
+        print "  time per item:     %8.1f us" % (elapsed * 1e6 / len(items))
+        print "  size per dict:     %8.0f bytes" % (float(size) / len(items))
+        channel._cache.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def htmltmpl_render(counts=(100, 200, 400, 800, 1600)):
+    """Time taken to render the Atom template, as the items grow.
+
+    The template is rendered both by interpreting its tokens and
+    by the Python function it is compiled to.
+    """
+    template_file = os.path.join(os.path.dirname(planet.__file__),
+                                 "templates", "atom.xml.tmpl")
+    template = htmltmpl.TemplateManager(precompile=0).prepare(template_file)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print "htmltmpl_render: %s" % os.path.basename(template_file)
+        print "  %5s                 %8s   %8s" % ("", "interpret", "compiled")
+        for count in counts:
+            channel = make_channel(BenchPlanet(tmpdir),
+                                   "http://bench/render/%d" % count, count)
+            channel_info = planet.template_info(channel, planet.DATE_FORMAT)
+            items = []
+            for item in channel.items(sort=True):
+                info = planet.template_info(item, planet.DATE_FORMAT)
+                info.chain("channel_", channel_info)
+                items.append(info)
+            processor = htmltmpl.TemplateProcessor(html_escape=0)
+            processor.set("Items", items)
+            processor.set("Channels", [channel_info])
+            # Compute the deferred values before timing either way
+            processor.process(template)
+            times = []
+            for method in processor.interpret, processor.generate:
+                # Keep collections of the growing model out of the timing
+                gc.collect()
+                gc.disable()
+                try:
+                    start = time.time()
+                    "".join(method(template))
+                    times.append(time.time() - start)
+                finally:
+                    gc.enable()
+            print "  %5d items: us per item %8.1f   %8.1f" % (
+                count, times[0] * 1e6 / count, times[1] * 1e6 / count)
+            channel._cache.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def feed_templates(count=1000, repeat=3):
+    """Time taken to render each bundled feed with htmltmpl and with Jinja."""
+    templates_dir = os.path.join(os.path.dirname(planet.__file__),
+                                 "templates")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        channel = make_channel(BenchPlanet(tmpdir), "http://bench/feeds", count)
+        channel_info = planet.template_info(channel, planet.DATE_FORMAT)
+        items = []
+        for item in channel.items(sort=True):
+            info = planet.template_info(item, planet.DATE_FORMAT)
+            info.chain("channel_", channel_info)
+            items.append(info)
+        channels = [channel_info]
+        planet_kwargs = {"name": "Bench", "link": "http://bench/",
+                         "feed": "http://bench/atom.xml",
+                         "owner_name": "Owner", "owner_email": "o@bench"}
+        compiled_directory = os.path.join(tmpdir, "compiled")
+        print "feed_templates: %d items, best of %d" % (count, repeat)
+        print "  %-13s %9s %9s" % ("", "htmltmpl", "jinja")
+        for name in sorted(os.listdir(templates_dir)):
+            if not name.endswith(".tmpl"):
+                continue
+            times = []
+            for template_file in name, os.path.splitext(name)[0]:
+                template_file = os.path.join(templates_dir, template_file)
+                unicode_lists = planet.model.unicode_lists(channels, items)
+                best = None
+                # The first time round compiles and fills in the model
+                for i in range(repeat + 1):
+                    gc.collect()
+                    gc.disable()
+                    try:
+                        start = time.time()
+                        planet.render.render_template(
+                            template_file, tmpdir, planet.DATE_FORMAT,
+                            "utf-8", channels, items, planet_kwargs, (),
+                            compiled_directory, unicode_lists)
+                        elapsed = time.time() - start
+                    finally:
+                        gc.enable()
+                    if i and (best is None or elapsed < best):
+                        best = elapsed
+                times.append(best)
+            print "  %-13s %7.1f ms %6.1f ms" % (
+                os.path.splitext(name)[0], times[0] * 1e3, times[1] * 1e3)
+        channel._cache.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    names = argv or [b.__name__ for b in BENCHMARKS]
+    for bench in BENCHMARKS:
+        if bench.__name__ in names:
+            bench()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,10 +10,33 @@ This module provides the code to handle this cache transparently enough
 that the rest of the code can take the persistance for granted.
 """
 
+import calendar
+from collections import OrderedDict
+import cPickle
+import dbhash
+from hashlib import sha1
 import os
 import re
+import threading
+import time
+import zlib
 
 
+# Strings longer than this many bytes are stored compressed
+COMPRESS_THRESHOLD = 512
+
+# Keys whose long values are kept in the BlobStore, when there is one
+BLOB_KEYS = ("content", "summary")
+
+# Length of the stamp of the source kept with derived values
+DERIVED_STAMP = 16
+
+# Extension of the journals of commits, see write_journal()
+JOURNAL_EXTENSION = ".journal"
+
+# Journal of the commits of a GroupWriter, in the cache directory
+GROUP_JOURNAL = ".group" + JOURNAL_EXTENSION
+
 # Regular expressions to sanitise cache filenames
 re_url_scheme    = re.compile(r'^[^:]*://')
 re_slash         = re.compile(r'[?/]+')
@@ -32,15 +55,43 @@ class CachedInfo(object):
     If you wish to support special fields you can derive a class off this
     and implement get_FIELD and set_FIELD functions which will be
     automatically called.
+
+    Large caches hold hundreds of thousands of these, so the fields are
+    kept compactly: the field names are in a _Layout shared by all the
+    instances with the same fields, which also maps each name to its
+    position, and each field occupies a tag and a value slot in a single
+    flat list.  Dates are held as integer UTC timestamps, so a date is
+    read back as time.gmtime() gives it, whatever weekday, day of the
+    year or DST flag it was set with.  Long strings are zlib compressed
+    both in memory and in the cache; they are only decompressed when
+    read.  Long values of BLOB_KEYS are kept in the
+    blob_store() instead, if there is one, and only referred to here.
     """
     STRING = "string"
     DATE   = "date"
     NULL   = "null"
+    ZLIB   = "zlib"
+    BLOB   = "blob"
+
+    # Type tags stored alongside each value.  UNCACHED is or-ed in for
+    # values that should not be written back to the cache.
+    _STRING   = 0
+    _DATE     = 1
+    _NULL     = 2
+    _ZLIB     = 3
+    _BLOB     = 4
+    _UNCACHED = 8
+    _TYPES = (STRING, DATE, NULL, ZLIB, BLOB)
+    _TAGS = {STRING: _STRING, DATE: _DATE, NULL: _NULL, ZLIB: _ZLIB,
+             BLOB: _BLOB}
+    # Compression is transparent, so compressed strings are still strings
+    _KEY_TYPES = (STRING, DATE, NULL, STRING, STRING)
+
+    __slots__ = ("_cache", "_id", "_root", "_layout", "_values")
 
     def __init__(self, cache, id_, root=0):
-        self._type = {}
-        self._value = {}
-        self._cached = {}
+        self._layout = _EMPTY_LAYOUT
+        self._values = []
 
         self._cache = cache
         self._id = id_.replace(" ", "%20")
@@ -56,6 +107,10 @@ class CachedInfo(object):
 
     def cache_read(self):
         """Read information from the cache."""
+        self.cache_load(self.cache_fields())
+
+    def cache_fields(self):
+        """Return the (key, tag, value) fields stored in the cache."""
         if self._root:
             keys_key = " keys"
         else:
@@ -64,33 +119,47 @@ class CachedInfo(object):
         if self._cache.has_key(keys_key):
             keys = self._cache[keys_key].split(" ")
         else:
-            return
+            return []
 
+        fields = []
         for key in keys:
             cache_key = self.cache_key(key)
-            if not self._cached.has_key(key) or self._cached[key]:
+            tag = self._TAGS[self._cache[cache_key + " type"]]
+            value = self._cache[cache_key]
+            if tag == self._DATE:
+                value = timestamp([ int(i) for i in value.split(" ") ])
+            fields.append((key, tag, value))
+        return fields
+
+    def cache_load(self, fields):
+        """Load (key, tag, value) fields, as returned by cache_fields()."""
+        for key, tag, value in fields:
+            index = self._index(key)
+            if index < 0 or not self._values[index * 2] & self._UNCACHED:
                 # Key either hasn't been loaded, or is one for the cache
-                self._value[key] = self._cache[cache_key]
-                self._type[key] = self._cache[cache_key + " type"]
-                self._cached[key] = 1
+                self._store(key, tag, value)
 
     def cache_write(self, sync=1):
         """Write information to the cache."""
         self.cache_clear(sync=0)
 
         keys = []
-        for key in self.keys():
+        for index, key in enumerate(self._layout.keys):
             cache_key = self.cache_key(key)
-            if not self._cached[key]:
+            tag = self._values[index * 2]
+            if tag & self._UNCACHED:
                 if self._cache.has_key(cache_key):
                     # Non-cached keys need to be cleared
                     del(self._cache[cache_key])
                     del(self._cache[cache_key + " type"])
                 continue
 
+            value = self._values[index * 2 + 1]
+            if tag == self._DATE:
+                value = " ".join([ str(s) for s in time.gmtime(value) ])
             keys.append(key)
-            self._cache[cache_key] = self._value[key]
-            self._cache[cache_key + " type"] = self._type[key]
+            self._cache[cache_key] = value
+            self._cache[cache_key + " type"] = self._TYPES[tag]
 
         if self._root:
             keys_key = " keys"
@@ -122,15 +191,56 @@ class CachedInfo(object):
         if sync:
             self._cache.sync()
 
+    def _index(self, key):
+        """Return the position of key in the field list, or -1."""
+        return self._layout.positions.get(key, -1)
+
+    def _store(self, key, tag, value):
+        """Store value under key with the given type tag."""
+        index = self._index(key)
+        if index < 0:
+            self._layout = self._layout.add(intern(str(key)))
+            self._values.append(tag)
+            self._values.append(value)
+        else:
+            self._values[index * 2] = tag
+            self._values[index * 2 + 1] = value
+
+    def _tag(self, type_, cached):
+        """Return the tag for a value of type_."""
+        if cached:
+            return type_
+        return type_ | self._UNCACHED
+
+    def blob_store(self):
+        """Return the BlobStore for long values, or None if there is none."""
+        return None
+
     def has_key(self, key):
         """Check whether the key exists."""
         key = key.replace(" ", "_")
-        return self._value.has_key(key)
+        return key in self._layout.positions
 
     def key_type(self, key):
         """Return the key type."""
         key = key.replace(" ", "_")
-        return self._type[key]
+        index = self._index(key)
+        if index < 0:
+            raise KeyError, key
+        return self._KEY_TYPES[self._values[index * 2] & ~self._UNCACHED]
+
+    def is_compressed(self, key):
+        """Check whether the key holds a compressed string.
+
+        Compressed values (including those in the blob store) are only
+        decompressed when they are read, so callers can use this to avoid
+        reading values they may not need.
+        """
+        key = key.replace(" ", "_")
+        index = self._index(key)
+        return index >= 0 and \
+            self._values[index * 2] & ~self._UNCACHED in (self._ZLIB,
+                                                          self._BLOB)
 
     def set(self, key, value, cached=1):
         """Set the value of the given key.
@@ -172,13 +282,13 @@ class CachedInfo(object):
             return func(key)
 
         try:
-            func = getattr(self, "get_as_" + self._type[key])
+            func = getattr(self, "get_as_" + self.key_type(key))
         except AttributeError:
             pass
         else:
             return func(key)
 
-        return self._value[key]
+        return self._values[self._index(key) * 2 + 1]
 
     def set_as_string(self, key, value, cached=1):
         """Set the key to the string value.
@@ -186,42 +296,68 @@ class CachedInfo(object):
         The value is converted to UTF-8 if it is a Unicode string, otherwise
         it's assumed to have failed decoding (feedparser tries pretty hard)
         so has all non-ASCII characters stripped.
+
+        Values longer than COMPRESS_THRESHOLD are compressed, or put in
+        the blob store if the key is one of BLOB_KEYS.
         """
         value = utf8(value)
 
         key = key.replace(" ", "_")
-        self._value[key] = value
-        self._type[key] = self.STRING
-        self._cached[key] = cached
+        type_ = self._STRING
+        if len(value) > COMPRESS_THRESHOLD:
+            blobs = self.blob_store()
+            if blobs is not None and key in BLOB_KEYS:
+                value = blobs.put(value)
+                type_ = self._BLOB
+            else:
+                compressed = zlib.compress(value)
+                if len(compressed) < len(value):
+                    value = compressed
+                    type_ = self._ZLIB
+
+        self._store(key, self._tag(type_, cached), value)
 
     def get_as_string(self, key):
         """Return the key as a string value."""
         key = key.replace(" ", "_")
-        if not self.has_key(key):
+        index = self._index(key)
+        if index < 0:
             raise KeyError, key
 
-        return self._value[key]
+        type_ = self._values[index * 2] & ~self._UNCACHED
+        if type_ == self._ZLIB:
+            return zlib.decompress(self._values[index * 2 + 1])
+        elif type_ == self._BLOB:
+            return self.blob_store().get(self._values[index * 2 + 1])
+        return self._values[index * 2 + 1]
 
     def set_as_date(self, key, value, cached=1):
         """Set the key to the date value.
 
         The date should be a 9-item tuple as returned by time.gmtime().
         """
-        value = " ".join([ str(s) for s in value ])
+        value = timestamp(value)
 
         key = key.replace(" ", "_")
-        self._value[key] = value
-        self._type[key] = self.DATE
-        self._cached[key] = cached
+        self._store(key, self._tag(self._DATE, cached), value)
 
     def get_as_date(self, key):
         """Return the key as a date value."""
         key = key.replace(" ", "_")
-        if not self.has_key(key):
+        index = self._index(key)
+        if index < 0:
+            raise KeyError, key
+
+        return tuple(time.gmtime(self._values[index * 2 + 1]))
+
+    def get_as_timestamp(self, key):
+        """Return the date key as an integer UTC timestamp."""
+        key = key.replace(" ", "_")
+        index = self._index(key)
+        if index < 0:
             raise KeyError, key
 
-        value = self._value[key]
-        return tuple([ int(i) for i in value.split(" ") ])
+        return self._values[index * 2 + 1]
 
     def set_as_null(self, key, value, cached=1):
         """Set the key to the null value.
@@ -229,9 +365,7 @@ class CachedInfo(object):
         This only exists to make things less magic.
         """
         key = key.replace(" ", "_")
-        self._value[key] = ""
-        self._type[key] = self.NULL
-        self._cached[key] = cached
+        self._store(key, self._tag(self._NULL, cached), "")
 
     def get_as_null(self, key):
         """Return the key as the null value."""
@@ -241,23 +375,49 @@ class CachedInfo(object):
 
         return None
 
+    def get_derived(self, key, source, func):
+        """Return func() of the string in source, kept as key.
+
+        The result is stored under key along with a stamp of the value
+        it was derived from, so it is written to the cache like any other
+        field and only worked out again, in this run or a later one, once
+        the source value changes.  It is read back with this method too.
+        derived_changed() is called when a new value is worked out, as it
+        still has to be written to the cache.
+        """
+        value = self.get_as_string(source)
+        stamp = sha1(value).hexdigest()[:DERIVED_STAMP] + " "
+        key = key.replace(" ", "_")
+        if self._index(key) >= 0:
+            derived = self.get_as_string(key)
+            if derived.startswith(stamp):
+                return derived[len(stamp):]
+        derived = utf8(func(value))
+        self.set_as_string(key, stamp + derived)
+        self.derived_changed()
+        return derived
+
+    def derived_changed(self):
+        """Note that get_derived() stored a new value, nothing by default."""
+        pass
+
     def del_key(self, key):
         """Delete the given key."""
         key = key.replace(" ", "_")
-        if not self.has_key(key):
+        index = self._index(key)
+        if index < 0:
             raise KeyError, key
 
-        del(self._value[key])
-        del(self._type[key])
-        del(self._cached[key])
+        self._layout = self._layout.remove(key)
+        del(self._values[index * 2:index * 2 + 2])
 
     def keys(self):
         """Return the list of cached keys."""
-        return self._value.keys()
+        return list(self._layout.keys)
 
     def __iter__(self):
         """Iterate the cached keys."""
-        return iter(self._value.keys())
+        return iter(self.keys())
 
     # Special methods
     __contains__ = has_key
@@ -268,12 +428,12 @@ class CachedInfo(object):
 
     def __setattr__(self, key, value):
         if key.startswith("_"):
-            self.__dict__[key] = value
+            object.__setattr__(self, key, value)
         else:
             self.set(key, value)
 
     def __getattr__(self, key):
-        if self.has_key(key):
+        if not key.startswith("_") and self.has_key(key):
             return self.get(key)
         else:
             raise AttributeError, key
@@ -285,6 +445,480 @@ class CachedInfo(object):
     __repr__ = __str__
 
 
+class _Layout(object):
+    """The field names of CachedInfo instances, in order.
+
+    Instances with the same fields, set in the same order, share one
+    layout rather than each keeping a list of the names, and positions
+    maps each name to its index so finding a field is a dict lookup.
+    Layouts are reached from _EMPTY_LAYOUT by adding names one at a
+    time, so there is only one for each order of names, and they are
+    kept for as long as Planet runs.
+    """
+
+    __slots__ = ("keys", "positions", "_added")
+
+    def __init__(self, keys=()):
+        self.keys = keys
+        self.positions = dict((key, index) for index, key in enumerate(keys))
+        self._added = {}
+
+    def add(self, key):
+        """Return the layout with key added at the end."""
+        layout = self._added.get(key)
+        if layout is None:
+            layout = self._added.setdefault(key, _Layout(self.keys + (key,)))
+        return layout
+
+    def remove(self, key):
+        """Return the layout without key."""
+        layout = _EMPTY_LAYOUT
+        for other in self.keys:
+            if other != key:
+                layout = layout.add(other)
+        return layout
+
+
+_EMPTY_LAYOUT = _Layout()
+
+
+class CacheFile(object):
+    """A dbhash cache file whose changes are committed in whole batches.
+
+    Changes are held in memory, where reads still see them, until sync()
+    marks everything changed so far as one finished batch.  Without a
+    writer the batch is committed there and then; with a GroupWriter it
+    is committed later, together with the batches of other files.
+    Either way the batches go to a journal on disk before the file, see
+    write_journal(), so if a run crashes while writing them recover()
+    can finish the job, and the file ends up as it was after some
+    complete update.
+
+    changes counts the changes synced so far.  The file is only opened
+    once it is needed.  Given a HandlePool, it is only kept open while
+    the pool has room for it, and is reopened whenever it is needed again.
+    """
+
+    def __init__(self, filename, writer=None, pool=None):
+        self.filename = filename
+        self._writer = writer
+        self._pool = pool
+        self._file = None
+        self.changes = 0
+        # Pending changes; a value of None marks a deleted key
+        self._changes = {}
+        self._ready = {}
+        self._committing = {}
+        self._lock = threading.RLock()
+
+    def _db(self):
+        """Return the open dbhash file, opening it if need be."""
+        if self._pool is not None:
+            self._pool.use(self)
+        elif self._file is None:
+            self._file = dbhash.open(self.filename, "c", 0666)
+        return self._file
+
+    def has_key(self, key):
+        with self._lock:
+            for changes in (self._changes, self._ready, self._committing):
+                if key in changes:
+                    return changes[key] is not None
+            return self._db().has_key(key)
+
+    __contains__ = has_key
+
+    def __getitem__(self, key):
+        with self._lock:
+            for changes in (self._changes, self._ready, self._committing):
+                if key in changes:
+                    if changes[key] is None:
+                        raise KeyError(key)
+                    return changes[key]
+            return self._db()[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._changes[key] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            if not self.has_key(key):
+                raise KeyError(key)
+            self._changes[key] = None
+
+    def keys(self):
+        with self._lock:
+            if not self._changes and not self._ready and \
+                   not self._committing:
+                return self._db().keys()
+            keys = set(self._db().keys())
+            for changes in (self._committing, self._ready, self._changes):
+                for key, value in changes.iteritems():
+                    if value is None:
+                        keys.discard(key)
+                    else:
+                        keys.add(key)
+            return list(keys)
+
+    def _stored(self, key):
+        """Return the value of key before the current batch, or None."""
+        for changes in (self._ready, self._committing):
+            if key in changes:
+                return changes[key]
+        db = self._db()
+        if db.has_key(key):
+            return db[key]
+        return None
+
+    def sync(self):
+        """Finish the current batch of changes.
+
+        Changes that leave a key as it was are dropped, so rewriting
+        unchanged information doesn't touch the file at all.
+        """
+        with self._lock:
+            changes = dict((key, value)
+                           for key, value in self._changes.iteritems()
+                           if value != self._stored(key))
+            count = len(changes)
+            self.changes += count
+            self._ready.update(changes)
+            self._changes = {}
+        if self._writer is None:
+            self.commit()
+        elif count:
+            self._writer.ready(self, count)
+
+    def commit(self):
+        """Write the finished batches to disk, through a journal."""
+        with self._lock:
+            changes = self.take_ready()
+            if changes:
+                journal = self.filename + JOURNAL_EXTENSION
+                write_journal(journal, [(self.filename, changes)])
+                self.write_committing()
+                os.remove(journal)
+
+    def take_ready(self):
+        """Return the finished batches, which are to be committed.
+
+        Reads still see them until write_committing() has written them.
+        """
+        with self._lock:
+            self._committing.update(self._ready)
+            self._ready = {}
+            return dict(self._committing)
+
+    def write_committing(self):
+        """Write the batches taken by take_ready() to the file."""
+        with self._lock:
+            if not self._committing:
+                return
+            db = self._db()
+            _write_changes(db, self._committing)
+            self._committing = {}
+            db.sync()
+
+    def close(self):
+        """Commit all changes and close the file."""
+        with self._lock:
+            self._ready.update(self._changes)
+            self._changes = {}
+            self.commit()
+            if self._pool is not None:
+                self._pool.discard(self)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class HandlePool(object):
+    """A bounded pool of open cache files.
+
+    Keeps at most size CacheFiles open, closing the least recently used
+    one to make room for another, so the number of file descriptors
+    Planet needs doesn't grow with the number of channels.  Files that
+    are busy in another thread are never closed, so the pool can grow
+    past size for a moment.  All methods are thread safe.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.opens = 0
+        self.reopens = 0
+        self.peak = 0
+        self._open = OrderedDict()
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def use(self, cache_file):
+        """Make cache_file the most recently used, opening it if need be."""
+        with self._lock:
+            if self._open.pop(cache_file, None) is None:
+                self._evict()
+                cache_file._file = dbhash.open(cache_file.filename, "c", 0666)
+                self.opens += 1
+                if cache_file.filename in self._seen:
+                    self.reopens += 1
+                self._seen.add(cache_file.filename)
+            self._open[cache_file] = True
+            self.peak = max(self.peak, len(self._open))
+
+    def discard(self, cache_file):
+        """Forget cache_file, which its owner is closing."""
+        with self._lock:
+            self._open.pop(cache_file, None)
+
+    def _evict(self):
+        for cache_file in self._open.keys():
+            if len(self._open) < self.size:
+                break
+            if cache_file._lock.acquire(False):
+                try:
+                    cache_file._file.close()
+                    cache_file._file = None
+                finally:
+                    cache_file._lock.release()
+                del(self._open[cache_file])
+
+
+class GroupWriter(object):
+    """Commits the finished batches of many cache files together.
+
+    Files hand their batches to the writer rather than syncing each one
+    as it is updated.  The writer commits them all every commit_every
+    changes, or only when commit() is called if that is 0.  Each commit
+    syncs every file with changes once, however many batches it has, so
+    the blob store is synced once rather than after every channel, and a
+    channel that is written more than once is still synced once.  Every
+    changed file still costs a sync per commit, they are separate files,
+    but the batches of all of them share one journal, and its sync.
+    Files are committed in the order they became ready, so blobs are on
+    disk before the channels that refer to them.  All methods are thread
+    safe.
+    """
+
+    def __init__(self, commit_every=0):
+        self.commit_every = commit_every
+        self.commits = 0
+        self.changes = 0
+        self._files = []
+        self._queued = set()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def ready(self, cache_file, count):
+        """Note that cache_file has count changes ready to commit."""
+        with self._lock:
+            if cache_file not in self._queued:
+                self._queued.add(cache_file)
+                self._files.append(cache_file)
+            self._count += count
+            if self.commit_every and self._count >= self.commit_every:
+                self._commit()
+
+    def commit(self):
+        """Commit every file with changes ready."""
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        if not self._files:
+            return
+        # One journal for all the files, so it costs a single sync
+        batches = [(cache_file.filename, cache_file.take_ready())
+                   for cache_file in self._files]
+        journal = os.path.join(os.path.dirname(self._files[0].filename),
+                               GROUP_JOURNAL)
+        write_journal(journal, batches)
+        for cache_file in self._files:
+            cache_file.write_committing()
+        os.remove(journal)
+        self.commits += 1
+        self.changes += self._count
+        self._files = []
+        self._queued = set()
+        self._count = 0
+
+
+class BlobStore(object):
+    """Content-addressed storage for long values, shared by all channels.
+
+    Item bodies are stored once, compressed and keyed by their SHA-1,
+    however many channels carry them.  The channels only store the key.
+    The results of sanitizing long raw content are remembered too, so
+    the same content is never sanitized twice.
+
+    Blobs are never removed while Planet runs; collect() drops the ones
+    nothing refers to any more.  All methods are thread safe.  Given a
+    GroupWriter, the blobs are committed along with the channels.
+    """
+    FILENAME = ".blobs"
+    SANITIZED = "sanitized "
+
+    def __init__(self, directory, writer=None):
+        self.filename = os.path.join(directory, self.FILENAME)
+        self._file = CacheFile(self.filename, writer)
+        self._lock = threading.Lock()
+
+    def put(self, value):
+        """Store the string value and return its key."""
+        digest = sha1(value).hexdigest()
+        with self._lock:
+            if not self._file.has_key(digest):
+                self._file[digest] = zlib.compress(value)
+        return digest
+
+    def get(self, digest):
+        """Return the string stored under digest."""
+        with self._lock:
+            value = self._file[digest]
+        return zlib.decompress(value)
+
+    def sanitize(self, raw, func):
+        """Return func(raw) as a UTF-8 string, reusing earlier results.
+
+        Only long values are remembered, sanitizing short ones is cheap.
+        """
+        raw_utf8 = utf8(raw)
+        if len(raw_utf8) <= COMPRESS_THRESHOLD:
+            return func(raw)
+
+        memo_key = self.SANITIZED + sha1(raw_utf8).hexdigest()
+        with self._lock:
+            if self._file.has_key(memo_key):
+                digest = self._file[memo_key]
+                if self._file.has_key(digest):
+                    return zlib.decompress(self._file[digest])
+
+        value = utf8(func(raw))
+        digest = self.put(value)
+        with self._lock:
+            self._file[memo_key] = digest
+        return value
+
+    def collect(self, referenced):
+        """Remove the blobs whose keys are not in the referenced set.
+
+        Returns the number of blobs removed.
+        """
+        removed = 0
+        with self._lock:
+            keys = self._file.keys()
+            for key in keys:
+                if not key.startswith(self.SANITIZED) and \
+                       key not in referenced:
+                    del(self._file[key])
+                    removed += 1
+            for key in keys:
+                if key.startswith(self.SANITIZED) and \
+                       not self._file.has_key(self._file[key]):
+                    del(self._file[key])
+            self._file.sync()
+        return removed
+
+    def sync(self):
+        """Write the blobs to disk."""
+        with self._lock:
+            self._file.sync()
+
+    def close(self):
+        """Write the blobs to disk and close the store."""
+        with self._lock:
+            self._file.close()
+
+
+def _write_changes(db, changes):
+    """Write changes, a dict whose None values mark deleted keys, to db."""
+    for key, value in changes.iteritems():
+        if value is not None:
+            db[key] = value
+        elif db.has_key(key):
+            del(db[key])
+
+
+def write_journal(journal, batches):
+    """Write a journal of the batches about to be committed.
+
+    batches is a list of (filename, changes) pairs.  The journal is
+    complete and on disk before it has its name, so if there is one,
+    recover() can write the batches again, whatever state the files
+    were left in.  It is removed once they are all written.
+    """
+    directory = os.path.dirname(journal)
+    batches = [(os.path.relpath(filename, directory), changes)
+               for filename, changes in batches]
+    tmp_journal = journal + ".tmp"
+    with open(tmp_journal, "wb") as f:
+        cPickle.dump(batches, f, cPickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_journal, journal)
+
+
+def recover(directory):
+    """Finish the commits of the caches in directory that were cut short.
+
+    Every journal left there is written to its files again, and then
+    removed.  Must be called before the caches are used.  Returns the
+    number of journals.
+    """
+    journals = [name for name in os.listdir(directory)
+                if name.endswith(JOURNAL_EXTENSION)]
+    for name in journals:
+        journal = os.path.join(directory, name)
+        with open(journal, "rb") as f:
+            batches = cPickle.load(f)
+        for filename, changes in batches:
+            db = dbhash.open(os.path.join(directory, filename), "c", 0666)
+            try:
+                _write_changes(db, changes)
+            finally:
+                db.close()
+        os.remove(journal)
+    # Journals that were never finished, and so never committed
+    for name in os.listdir(directory):
+        if name.endswith(JOURNAL_EXTENSION + ".tmp"):
+            os.remove(os.path.join(directory, name))
+    return len(journals)
+
+
+def read_records(filename):
+    """Read and parse a channel's cache file.
+
+    Returns a (fields, entries) tuple, where fields are the channel's
+    own (key, tag, value) fields and entries is a list of (id, fields)
+    tuples for its items, or None if there is no such cache file.  Used
+    to load caches in worker processes, so it only returns plain data.
+    """
+    if not os.path.isfile(filename):
+        return None
+    cache_file = dbhash.open(filename, "r")
+    try:
+        fields = CachedInfo(cache_file, "", root=1).cache_fields()
+        channel_keys = set(key for key, tag, value in fields)
+        entries = [(key, CachedInfo(cache_file, key).cache_fields())
+                   for key in cache_file.keys()
+                   if key.find(" ") == -1 and key not in channel_keys]
+    finally:
+        cache_file.close()
+    return fields, entries
+
+
+def blob_references(filename):
+    """Return the set of blob keys a cache file refers to."""
+    references = set()
+    cache_file = dbhash.open(filename, "r")
+    try:
+        for key, value in cache_file.iteritems():
+            if key.endswith(" type") and value == CachedInfo.BLOB:
+                references.add(cache_file[key[:-len(" type")]])
+    finally:
+        cache_file.close()
+    return references
+
+
 def filename(directory, tail):
     """Return a filename suitable for the cache.
 
@@ -298,6 +932,47 @@ def filename(directory, tail):
 
     return os.path.join(directory, result)
 
+def compact(filename):
+    """Rewrite a cache file to drop the space left by deleted keys.
+
+    The records are copied into a new file which then replaces the old
+    one.  Returns the file sizes before and after.
+    """
+    size_before = os.path.getsize(filename)
+    tmp_filename = filename + ".compact"
+    try:
+        old = dbhash.open(filename, "r")
+        try:
+            new = dbhash.open(tmp_filename, "n", 0666)
+            try:
+                for key, value in old.iteritems():
+                    new[key] = value
+            finally:
+                new.close()
+        finally:
+            old.close()
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    return size_before, os.path.getsize(filename)
+
+def load_time(filename):
+    """Return the seconds taken to read every record of a cache file."""
+    start = time.time()
+    cache_file = dbhash.open(filename, "r")
+    try:
+        for key, value in cache_file.iteritems():
+            pass
+    finally:
+        cache_file.close()
+    return time.time() - start
+
+def timestamp(date):
+    """Return the 9-item UTC date tuple as an integer timestamp."""
+    return calendar.timegm(tuple(date))
+
 def utf8(value):
     """Return the value as a UTF-8 string."""
     if type(value) == type(u''):
@@ -310,3 +985,130 @@ def utf8(value):
                 return unicode(value, "iso-8859-1").encode("utf-8")
             except UnicodeError:
                 return unicode(value, "ascii", "replace").encode("utf-8")
+
+
+def _shorten(value, width):
+    """Return value on a single line of at most width characters."""
+    value = " ".join(str(value).split())
+    if width and len(value) > width:
+        value = value[:width - 3] + "..."
+    return value
+
+
+def _format_value(info, key, width):
+    """Return the value of key in info formatted for display."""
+    if info.key_type(key) == CachedInfo.DATE:
+        return time.strftime("%Y-%m-%dT%H:%M:%S", info.get_as_date(key))
+    elif info.key_type(key) == CachedInfo.NULL:
+        return "(null)"
+    return _shorten(info.get_as_string(key), width)
+
+
+def _print_items(items):
+    for item in items:
+        print "%s  %-20s  %s" % (
+            time.strftime("%Y-%m-%d %H:%M", item.date),
+            _shorten(item._channel.name, 20), item.id)
+        if item.has_key("title"):
+            print "%16s  %s" % ("", _shorten(item.title, 60))
+
+
+def list_channels(planet, args):
+    """List channels with their item counts, cache sizes and status."""
+    print "%6s %10s %6s  %-19s  %s" % (
+        "Items", "Bytes", "Status", "Updated", "Channel")
+    for channel in planet.channels(hidden=True):
+        cache_file = filename(planet.cache_directory, channel.configured_url)
+        size = os.path.isfile(cache_file) and os.path.getsize(cache_file)
+        updated = "never"
+        if channel.has_key("updated") and \
+               channel.key_type("updated") == CachedInfo.DATE:
+            updated = _format_value(channel, "updated", 0)
+        print "%6d %10d %6s  %-19s  %s <%s>" % (
+            len(channel.items(hidden=True)), size,
+            channel.url_status or "-", updated, channel.name, channel.url)
+
+
+def newest_items(planet, args):
+    """Show the newest items across the planet."""
+    _print_items(planet.items(hidden=args.hidden, max_items=args.count))
+
+
+def dump_item(planet, args):
+    """Show every field of one item, with its type."""
+    item = None
+    for channel in planet.channels(hidden=True):
+        if channel.has_item(args.id):
+            item = channel.get_item(args.id)
+            break
+    if item is None:
+        print "No item with id %s" % args.id
+        return 1
+
+    print "Channel: %s <%s>" % (item._channel.name, item._channel.url)
+    width = not args.full and 60
+    for key in sorted(item.keys()):
+        type_ = item.key_type(key)
+        if item.is_compressed(key):
+            type_ += "*"
+        print "%-20s %-7s %s" % (key, type_, _format_value(item, key, width))
+
+
+def find_items(planet, args):
+    """Find items whose id or title contains the text."""
+    text = args.text.lower()
+    found = []
+    for channel in planet.channels(hidden=True):
+        for item in channel.items(hidden=True, sort=True):
+            if text in item.id.lower() or \
+                   (item.has_key("title") and text in item.title.lower()):
+                found.append(item)
+    _print_items(found)
+
+
+def main(argv=None):
+    import argparse
+    import logging
+    import planet
+    from planet.__main__ import read_config
+
+    parser = argparse.ArgumentParser(
+        prog="python -m planet.cache",
+        description="Examine the cache of a Planet.")
+    parser.add_argument("config_file", help="Path to configuration ini file.")
+    commands = parser.add_subparsers(title="commands")
+
+    command = commands.add_parser("channels", help=list_channels.__doc__)
+    command.set_defaults(func=list_channels)
+
+    command = commands.add_parser("newest", help=newest_items.__doc__)
+    command.add_argument("count", nargs="?", type=int, default=20,
+                         help="Number of items to show (default 20).")
+    command.add_argument("--hidden", action="store_true",
+                         help="Include hidden items.")
+    command.set_defaults(func=newest_items)
+
+    command = commands.add_parser("dump", help=dump_item.__doc__)
+    command.add_argument("id", help="Id of the item.")
+    command.add_argument("-f", "--full", action="store_true",
+                         help="Show whole values rather than the start. "
+                              "Compressed values are marked with '*'.")
+    command.set_defaults(func=dump_item)
+
+    command = commands.add_parser("find", help=find_items.__doc__)
+    command.add_argument("text", help="Text to look for (case insensitive).")
+    command.set_defaults(func=find_items)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARN)
+
+    my_planet = planet.Planet(read_config(args.config_file))
+    my_planet.configure_cache()
+    my_planet.load_channels(processes=int(my_planet.tmpl_config_get(
+        "load_processes", planet.LOAD_PROCESSES)), read_only=True)
+    return args.func(my_planet, args)
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -44,6 +44,9 @@ import cgi          # for HTML escaping of variables
 import urllib       # for URL escaping of variables
 import cPickle      # for template compilation
 import gettext
+from hashlib import md5   # for names of precompiled templates
+import imp          # for the magic number of compiled Python code
+import marshal      # for saving templates compiled to Python
 
 INCLUDE_DIR = "inc"
 
@@ -72,12 +75,12 @@ class TemplateManager:
     """
 
     def __init__(self, include=1, max_include=5, precompile=1, comments=1,
-                 gettext=0, debug=0):
+                 gettext=0, debug=0, precompile_dir=None):
         """ Constructor.
         
             @header
             __init__(include=1, max_include=5, precompile=1, comments=1,
-                     gettext=0, debug=0)
+                     gettext=0, debug=0, precompile_dir=None)
             
             @param include Enable or disable included templates.
             This optional parameter can be used to enable or disable
@@ -95,13 +98,15 @@ class TemplateManager:
             creation and usage of precompiled templates.
       
             A precompiled template is saved to the same directory in
-            which the main template file is located. You need write
+            which the main template file is located, unless
+            <em>precompile_dir</em> is given. You need write
             permissions to that directory.
 
             Precompilation provides a significant performance boost because
             it's not necessary to parse the templates over and over again.
             The boost is especially noticeable when templates that include
-            other templates are used.
+            other templates are used. The precompiled form also holds
+            the Python function the template is compiled to.
             
             Comparison of modification times of the main template and all
             included templates is used to ensure that the precompiled
@@ -123,6 +128,13 @@ class TemplateManager:
             This optional parameter is a flag that can be used to enable
             or disable debugging messages which are printed to the standard
             error output. The debugging messages are disabled by default.
+
+            @param precompile_dir Directory for precompiled templates.
+            This optional parameter can be used to save the precompiled
+            templates to the given directory instead of the directories
+            of the template files, which need not be writable then.
+            The precompiled templates are named after the absolute paths
+            of the template files. The directory must exist.
         """
         # Save the optional parameters.
         # These values are not modified by any method.
@@ -132,6 +144,10 @@ class TemplateManager:
         self._comments = comments
         self._gettext = gettext
         self._debug = debug
+        self._precompile_dir = precompile_dir
+
+        # Templates prepared by this instance, by filename.
+        self._prepared = {}
 
         self.DEB("INIT DONE")
 
@@ -140,7 +156,8 @@ class TemplateManager:
             
             If precompilation is enabled then this method tries to load
             a precompiled form of the template from the same directory
-            in which the template source file is located. If it succeeds,
+            in which the template source file is located, or from the
+            <em>precompile_dir</em> directory. If it succeeds,
             then it compares modification times stored in the precompiled
             form to modification times of source files of the template,
             including source files of all templates included via the
@@ -150,6 +167,10 @@ class TemplateManager:
             
             If precompilation is disabled, then this method parses and
             compiles the template.
+
+            Either way, the template is kept in memory, and is not
+            compiled or loaded again by this instance as long as it and
+            the templates it includes stay unmodified.
             
             @header prepare(file)
             
@@ -164,6 +185,12 @@ class TemplateManager:
             be placed in subdirectory <strong>'inc'</strong> of the 
             directory in which the main template file is located.
         """
+        compile_params = (self._include, self._max_include, self._comments,
+                          self._gettext)
+        compiled = self._prepared.get(file)
+        if compiled is not None and compiled.is_uptodate(compile_params):
+            self.DEB("PREPARED: UPTODATE")
+            return compiled
         compiled = None
         if self._precompile:
             if self.is_precompiled(file):
@@ -176,8 +203,6 @@ class TemplateManager:
                     self.save_precompiled(compiled)
                 else:
                     precompiled.debug(self._debug)
-                    compile_params = (self._include, self._max_include,
-                                      self._comments, self._gettext)
                     if precompiled.is_uptodate(compile_params):
                         self.DEB("PRECOMPILED: UPTODATE")
                         compiled = precompiled
@@ -191,6 +216,7 @@ class TemplateManager:
         else:
             self.DEB("PRECOMPILATION DISABLED")
             compiled = self.compile(file)
+        self._prepared[file] = compiled
         return compiled
     
     def update(self, template):
@@ -235,13 +261,22 @@ class TemplateManager:
                                 self._comments, self._gettext,
                                 self._debug).compile(file)
     
+    def precompiled_file(self, file):
+        """ Return the filename of the precompiled form of a template.
+            @hidden
+        """
+        if self._precompile_dir is None:
+            return file + "c"   # "template.tmplc"
+        name = md5(os.path.abspath(file)).hexdigest() + ".tmplc"
+        return os.path.join(self._precompile_dir, name)
+
     def is_precompiled(self, file):
         """ Return true if the template is already precompiled on the disk.
             This method doesn't check whether the compiled template is
             uptodate.
             @hidden
         """
-        filename = file + "c"   # "template.tmplc"
+        filename = self.precompiled_file(file)
         if os.path.isfile(filename):
             return 1
         else:
@@ -255,7 +290,7 @@ class TemplateManager:
             
             @hidden
         """
-        filename = file + "c"   # "template.tmplc"
+        filename = self.precompiled_file(file)
         self.DEB("LOADING PRECOMPILED")
         try:
             remove_bad = 0
@@ -295,7 +330,7 @@ class TemplateManager:
             
             @hidden
         """
-        filename = template.file() + "c"   # creates "template.tmplc"
+        filename = self.precompiled_file(template.file())
         # Check if we have write permission to the template's directory.
         template_dir = os.path.dirname(os.path.abspath(filename))
         if not os.access(template_dir, os.W_OK):
@@ -485,6 +520,43 @@ class TemplateProcessor:
             If this parameter is not specified, then the whole template
             is processed, or all remaining parts are processed.
         """
+        return "".join(self.generate(template, part))
+
+    def generate(self, template, part=None):
+        """ Process a compiled template. Yield the result in pieces.
+
+            This method works like process(), but yields the result
+            piece by piece as the processing goes, so that it never has
+            to be held in memory all at once.
+
+            The template is processed by the Python function it was
+            compiled to, unless it could not be compiled or a part of it
+            is to be processed. Then it is interpreted.
+
+            @header generate(template, part=None)
+            @return Generator of the pieces of the result, as strings.
+
+            @param template A compiled template.
+            @param part The part of a multipart template to process.
+            See process().
+        """
+        function = template.function()
+        if function is None or part != None or self._current_pos or \
+           self._debug:
+            return self.interpret(template, part)
+        return function(self, self._vars)
+
+    def interpret(self, template, part=None):
+        """ Process a compiled template by interpreting its tokens.
+            Yield the result in pieces, like generate().
+
+            @header interpret(template, part=None)
+            @return Generator of the pieces of the result, as strings.
+
+            @param template A compiled template.
+            @param part The part of a multipart template to process.
+            See process().
+        """
         self.DEB("APP INPUT:")
         if self._debug: pprint.pprint(self._vars, sys.stderr)
         if part != None and (part == 0 or part < self._current_part):
@@ -507,10 +579,12 @@ class TemplateProcessor:
         loop_pass = []        # current pass of a loop (counted from zero)
         loop_start = []       # index of loop start in token list
         loop_total = []       # total number of passes in a loop
+        # Mappings of the current pass of each loop, preceded by the
+        # top-level variables. None for a loop with no passes.
+        scopes = [self._vars]
         
         tokens = template.tokens()
         len_tokens = len(tokens)
-        out = ""              # buffer for processed output
 
         # Recover position at which we ended after processing of last part.
         i = self._current_pos
@@ -540,8 +614,9 @@ class TemplateProcessor:
                     # the substitued and escaped variable to the output.
                     if DISABLE_OUTPUT not in output_control:
                         value = str(self.find_value(var, loop_name, loop_pass,
-                                                    loop_total, globalp))
-                        out += self.escape(value, escape)
+                                                    loop_total, scopes,
+                                                    globalp))
+                        yield self.escape(value, escape)
                         self.DEB("VAR: " + str(var))
 
                 elif token == "<TMPL_LOOP":
@@ -552,7 +627,7 @@ class TemplateProcessor:
 
                     # Find total number of passes in this loop.
                     passtotal = self.find_value(var, loop_name, loop_pass,
-                                                loop_total)
+                                                loop_total, scopes)
                     if not passtotal: passtotal = 0
                     # Push data for this loop on the stack.
                     loop_total.append(passtotal)
@@ -564,9 +639,11 @@ class TemplateProcessor:
                     # in this loop is zero.
                     if passtotal == 0:
                         # This loop is empty.
+                        scopes.append(None)
                         output_control.append(DISABLE_OUTPUT)
                         self.DEB("LOOP: DISABLE: " + str(var))
                     else:
+                        scopes.append(scopes[-1][var][0])
                         output_control.append(ENABLE_OUTPUT)
                         self.DEB("LOOP: FIRST PASS: %s TOTAL: %d"\
                                  % (var, passtotal))
@@ -578,7 +655,7 @@ class TemplateProcessor:
                     globalp = tokens[i + PARAM_GLOBAL]
                     skip_params = 1
                     if self.find_value(var, loop_name, loop_pass,
-                                       loop_total, globalp):
+                                       loop_total, scopes, globalp):
                         output_control.append(ENABLE_OUTPUT)
                         self.DEB("IF: ENABLE: " + str(var))
                     else:
@@ -592,7 +669,7 @@ class TemplateProcessor:
                     globalp = tokens[i + PARAM_GLOBAL]
                     skip_params = 1
                     if self.find_value(var, loop_name, loop_pass,
-                                      loop_total, globalp):
+                                      loop_total, scopes, globalp):
                         output_control.append(DISABLE_OUTPUT)
                         self.DEB("UNLESS: DISABLE: " + str(var))
                     else:
@@ -614,11 +691,13 @@ class TemplateProcessor:
                         loop_name.pop()
                         loop_start.pop()
                         loop_total.pop()
+                        scopes.pop()
                         output_control.pop()
                         self.DEB("LOOP: END")
                     else:
                         # Jump to the beggining of this loop block 
                         # to process next pass of the loop.
+                        scopes[-1] = scopes[-2][loop_name[-1]][loop_pass[-1]]
                         i = loop_start[-1]
                         self.DEB("LOOP: NEXT PASS")
      
@@ -667,7 +746,7 @@ class TemplateProcessor:
                     # when it was not replaced by the parser.
                     skip_params = 1
                     filename = tokens[i + PARAM_NAME]
-                    out += """
+                    yield """
                         <br />
                         <p>
                         <strong>HTMLTMPL WARNING:</strong><br />
@@ -681,7 +760,7 @@ class TemplateProcessor:
                     skip_params = 1
                     if DISABLE_OUTPUT not in output_control:
                         text = tokens[i + PARAM_GETTEXT_STRING]
-                        out += gettext.gettext(text)
+                        yield gettext.gettext(text)
                         self.DEB("GETTEXT: " + text)
                     
                 else:
@@ -691,8 +770,8 @@ class TemplateProcessor:
             elif DISABLE_OUTPUT not in output_control:
                 # Raw textual template data.
                 # If output of current block is not disabled, then 
-                # append template data to the output buffer.
-                out += token
+                # yield the template data.
+                yield token
                 
             i += 1
             # end of the big while loop
@@ -700,7 +779,6 @@ class TemplateProcessor:
         # Check whether all opening statements were closed.
         if loop_name: raise TemplateError, "Missing </TMPL_LOOP>."
         if output_control: raise TemplateError, "Missing </TMPL_IF> or </TMPL_UNLESS>"
-        return out
 
     ##############################################
     #              PRIVATE METHODS               #
@@ -712,12 +790,11 @@ class TemplateProcessor:
         """
         if self._debug: print >> sys.stderr, str
 
-    def find_value(self, var, loop_name, loop_pass, loop_total,
+    def find_value(self, var, loop_name, loop_pass, loop_total, scopes,
                    global_override=None):
-        """ Search the self._vars data structure to find variable var
-            located in currently processed pass of a loop which
-            is currently being processed. If the variable is an ordinary
-            variable, then return it.
+        """ Search for variable var in the currently processed pass of
+            the loop which is currently being processed. If the variable
+            is an ordinary variable, then return it.
             
             If the variable is an identificator of a loop, then 
             return the total number of times this loop will
@@ -726,6 +803,11 @@ class TemplateProcessor:
             Return an empty string, if the variable is not
             found at all.
 
+            The mappings of the current passes are kept in scopes,
+            innermost last, so the lookup does not depend on how deep
+            the loops are nested. Only a global lookup of a variable
+            missing from the current pass searches the outer passes.
+
             @hidden
         """
         # Search for the requested variable in magic vars if the name
@@ -733,45 +815,37 @@ class TemplateProcessor:
         if self._magic_vars and var.startswith("__") and loop_name:
             return self.magic_var(var, loop_pass[-1], loop_total[-1])
                     
-        # Search for an ordinary variable or for a loop.
-        # Recursively search in self._vars for the requested variable.
-        scope = self._vars
-        globals = []
-        for i in range(len(loop_name)):            
-            # If global lookup is on then push the value on the stack.
-            if ((self._global_vars and global_override != "0") or \
-                 global_override == "1") and scope.has_key(var) and \
-               self.is_ordinary_var(scope[var]):
-                globals.append(scope[var])
-            
-            # Descent deeper into the hierarchy.
-            if scope.has_key(loop_name[i]) and scope[loop_name[i]]:
-                scope = scope[loop_name[i]][loop_pass[i]]
-            else:
-                return ""
-            
+        # Search for an ordinary variable or for a loop in the current
+        # pass. There is none if an enclosing loop has no passes.
+        scope = scopes[-1]
+        if scope is None:
+            return ""
+
         if scope.has_key(var):
             # Value exists in current loop.
-            if type(scope[var]) == ListType:
+            value = scope[var]
+            if type(value) == ListType:
                 # The requested value is a loop.
                 # Return total number of its passes.
-                return len(scope[var])
+                return len(value)
             else:
-                return scope[var]
-        elif globals and \
-             ((self._global_vars and global_override != "0") or \
-               global_override == "1"):
-            # Return globally looked up value.
-            return globals.pop()
+                return value
+        elif (self._global_vars and global_override != "0") or \
+               global_override == "1":
+            # Return the value of the innermost enclosing pass
+            # that has it, if any.
+            for outer in reversed(scopes[:-1]):
+                if outer.has_key(var) and self.is_ordinary_var(outer[var]):
+                    return outer[var]
+
+        # No value found.
+        if var[0].isupper():
+            # This is a loop name.
+            # Return zero, because the user wants to know number
+            # of its passes.
+            return 0
         else:
-            # No value found.
-            if var[0].isupper():
-                # This is a loop name.
-                # Return zero, because the user wants to know number
-                # of its passes.
-                return 0
-            else:
-                return ""
+            return ""
 
     def magic_var(self, var, loop_pass, loop_total):
         """ Resolve and return value of a magic variable.
@@ -1225,6 +1299,239 @@ class TemplateCompiler:
             return None
 
 
+##############################################
+#        CLASS: TemplateCodeGenerator        #
+##############################################
+
+class TemplateCodeGenerator:
+    """ Generate a Python function from the tokens of a template.
+
+        The function does what the <em>TemplateProcessor</em> does when
+        it interprets the tokens, but the statements of the template are
+        turned into Python loops and conditionals, so that the tokens need
+        not be examined again whenever the template is processed.
+
+        The generated function is a generator which takes the
+        <em>TemplateProcessor</em> and its variables, and yields the result
+        in pieces: one for each pass of a top-level loop, and one for the
+        rest.
+
+        Templates which the function could not process exactly like the
+        interpreter are not compiled. These are multipart templates,
+        templates with statements that are not properly nested and
+        templates in which the interpreter would find errors.
+
+        @hidden
+    """
+
+    def __init__(self, tokens):
+        """ Constructor.
+            @hidden
+        """
+        self._tokens = tokens
+        self._lines = []
+        self._indent = 1
+        self._depth = 0         # number of enclosing loops
+        self._blocks = []       # open statements, innermost last
+        self._text = []         # template data not written yet
+
+    def generate(self):
+        """ Return the source of the function, which is named 'process'.
+            Raise UncompilableError if the template cannot be compiled.
+            @hidden
+        """
+        tokens = self._tokens
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token.startswith("<TMPL_") or token.startswith("</TMPL_"):
+                self.flush_text()
+                self.statement(token, *tokens[i + 1:i + 1 + PARAMS_NUMBER])
+                i += 1 + PARAMS_NUMBER
+            else:
+                self._text.append(token)
+                i += 1
+        self.flush_text()
+        if self._blocks:
+            raise UncompilableError, "Statement is not closed."
+        self.emit('yield "".join(out)')
+        header = ["def process(processor, scope0):",
+                  "    html_escape = processor._html_escape",
+                  "    magic_vars = processor._magic_vars",
+                  "    global_vars = processor._global_vars",
+                  "    magic_var = processor.magic_var",
+                  "    out = []",
+                  "    write = out.append"]
+        return "\n".join(header + self._lines) + "\n"
+
+    ##############################################
+    #              PRIVATE METHODS               #
+    ##############################################
+
+    def emit(self, line):
+        """ Add a line of the function at the current indentation.
+            @hidden
+        """
+        self._lines.append("    " * self._indent + line)
+
+    def flush_text(self):
+        """ Write the template data gathered since the last statement.
+            @hidden
+        """
+        text = "".join(self._text)
+        if text:
+            self.emit("write(%r)" % text)
+        self._text = []
+
+    def open_block(self, kind, name=None, indent=1):
+        """ Start the body of a statement.
+            @hidden
+        """
+        self._indent += indent
+        self._blocks.append((kind, name, len(self._lines), indent))
+
+    def close_block(self, *kinds):
+        """ End the body of the innermost statement, which must be one of
+            kinds. Return the name of the statement.
+            @hidden
+        """
+        if not self._blocks or self._blocks[-1][0] not in kinds:
+            raise UncompilableError, "Statements are not properly nested."
+        kind, name, start, indent = self._blocks.pop()
+        if len(self._lines) == start:
+            self.emit("pass")
+        self._indent -= indent
+        return name
+
+    def lookup(self, name, globalp, count_loops):
+        """ Add the code that finds the value of a variable like
+            TemplateProcessor.find_value() does, and assigns it to 'value'.
+            Loops are replaced by their number of passes only if
+            count_loops is true. Conditions do not need it.
+            @hidden
+        """
+        depth = self._depth
+        if name.startswith("__") and depth > 0:
+            self.emit("if magic_vars:")
+            self.emit("    value = magic_var(%r, pass%d, total%d)"
+                      % (name, depth, depth))
+            self.emit("else:")
+            self._indent += 1
+            self.lookup_scope(name, globalp, count_loops)
+            self._indent -= 1
+        else:
+            self.lookup_scope(name, globalp, count_loops)
+
+    def lookup_scope(self, name, globalp, count_loops):
+        """ Add the code that finds an ordinary variable or a loop.
+            @hidden
+        """
+        depth = self._depth
+        if name[0].isupper():
+            default = 0
+        else:
+            default = ""
+        self.emit("if %r in scope%d:" % (name, depth))
+        self.emit("    value = scope%d[%r]" % (depth, name))
+        if count_loops:
+            self.emit("    if type(value) is ListType: value = len(value)")
+        self.emit("else:")
+        outer = "(%s,)" % ", ".join(["scope%d" % i
+                                     for i in range(depth - 1, -1, -1)])
+        if depth == 0 or globalp == "0":
+            self.emit("    value = %r" % default)
+        elif globalp == "1":
+            self.emit("    value = outer_value(%s, %r, %r)"
+                      % (outer, name, default))
+        else:
+            self.emit("    if global_vars:")
+            self.emit("        value = outer_value(%s, %r, %r)"
+                      % (outer, name, default))
+            self.emit("    else:")
+            self.emit("        value = %r" % default)
+
+    def statement(self, token, name, escape, globalp):
+        """ Add the code of a statement.
+            @hidden
+        """
+        if token == "<TMPL_VAR":
+            if not name:
+                raise UncompilableError, "No identifier in <TMPL_VAR>."
+            self.lookup(name, globalp, 1)
+            value = "str(value)"
+            if escape == "HTML" or escape == "1":
+                self.emit("write(cgi_escape(%s, 1))" % value)
+            elif escape == "URL":
+                self.emit("write(quote_plus(%s))" % value)
+            elif escape == "NONE" or escape == "0":
+                self.emit("write(%s)" % value)
+            else:
+                self.emit("if html_escape:")
+                self.emit("    write(cgi_escape(%s, 1))" % value)
+                self.emit("else:")
+                self.emit("    write(%s)" % value)
+        elif token == "<TMPL_IF" or token == "<TMPL_UNLESS":
+            if not name:
+                raise UncompilableError, "No identifier in %s>." % token
+            self.lookup(name, globalp, 0)
+            if token == "<TMPL_IF":
+                self.emit("if value:")
+            else:
+                self.emit("if not value:")
+            self.open_block("IF", name)
+        elif token == "<TMPL_ELSE":
+            name = self.close_block("IF")
+            self.emit("else:")
+            self.open_block("ELSE", name)
+        elif token == "</TMPL_IF" or token == "</TMPL_UNLESS":
+            self.close_block("IF", "ELSE")
+        elif token == "<TMPL_LOOP":
+            # Magic variables used as loops are left to the interpreter.
+            if not name or name.startswith("__"):
+                raise UncompilableError, "Invalid identifier in <TMPL_LOOP>."
+            depth = self._depth
+            self.emit("loop%d = scope%d[%r] if %r in scope%d else None"
+                      % (depth + 1, depth, name, name, depth))
+            self.emit("if type(loop%d) is ListType:" % (depth + 1))
+            self.emit("    total%d = len(loop%d)" % (depth + 1, depth + 1))
+            self.emit("    for pass%d, scope%d in enumerate(loop%d):"
+                      % (depth + 1, depth + 1, depth + 1))
+            self.open_block("LOOP", name, 2)
+            self._depth += 1
+        elif token == "</TMPL_LOOP":
+            if self._depth == 1:
+                # Yield each pass of a top-level loop as it is done.
+                self.emit('yield "".join(out)')
+                self.emit("del out[:]")
+            name = self.close_block("LOOP")
+            # The interpreter fails on loops which are not lists,
+            # unless they are empty.
+            self.emit("elif loop%d:" % self._depth)
+            self.emit("    raise TemplateError, %r"
+                      % ("Loop '%s' is not a list." % name))
+            self._depth -= 1
+        elif token == "<TMPL_GETTEXT":
+            self.emit("write(gettext.gettext(%r))" % name)
+        else:
+            # Multipart templates, templates that could not be included
+            # and invalid statements.
+            raise UncompilableError, "Cannot compile %s>." % token
+
+
+def outer_value(scopes, var, default):
+    """ Return the value of the ordinary variable var in the first of
+        scopes which has it, or default. Used by the global lookups of
+        templates compiled to Python.
+        @hidden
+    """
+    for scope in scopes:
+        if scope.has_key(var):
+            value = scope[var]
+            if type(value) in (StringType, IntType, LongType, FloatType):
+                return value
+    return default
+
+
 ##############################################
 #              CLASS: Template               #
 ##############################################
@@ -1256,6 +1563,19 @@ class Template:
         self._debug = debug
         self._mtime = None        
         self._include_mtimes = {}
+        self._magic = imp.get_magic()
+        self._function = None
+
+        # Compile the tokens to a Python function, which is saved
+        # together with them as a marshalled code object.
+        try:
+            source = TemplateCodeGenerator(tokens).generate()
+        except UncompilableError, error:
+            self.DEB("TEMPLATE: NOT COMPILED TO PYTHON: " + str(error))
+            self._code = None
+        else:
+            self._code = marshal.dumps(compile(source, "<htmltmpl %s>" % file,
+                                               "exec"))
 
         if not file:
             self.DEB("TEMPLATE WAS COMPILED FROM A STRING")
@@ -1302,6 +1622,10 @@ class Template:
             self.DEB("TEMPLATE: VERSION NOT UPTODATE")
             return 0
 
+        if self._magic != imp.get_magic():
+            self.DEB("TEMPLATE: PYTHON VERSION NOT UPTODATE")
+            return 0
+
         if compile_params != None and compile_params != self._compile_params:
             self.DEB("TEMPLATE: DIFFERENT COMPILATION PARAMS")
             return 0
@@ -1339,6 +1663,22 @@ class Template:
         """
         return self._file
 
+    def function(self):
+        """ Get the Python function this template was compiled to.
+            Return None if the template could not be compiled.
+            @hidden
+        """
+        if self._function is None and self._code is not None:
+            namespace = {"ListType": ListType,
+                         "TemplateError": TemplateError,
+                         "cgi_escape": cgi.escape,
+                         "quote_plus": urllib.quote_plus,
+                         "gettext": gettext,
+                         "outer_value": outer_value}
+            exec marshal.loads(self._code) in namespace
+            self._function = namespace["process"]
+        return self._function
+
     def debug(self, debug):
         """ Get debugging state.
             @hidden
@@ -1351,19 +1691,25 @@ class Template:
 
     def __getstate__(self):
         """ Used by pickle when the class is serialized.
-            Remove the 'debug' attribute before serialization.
+            Remove the 'debug' attribute and the Python function
+            before serialization.
             @hidden
         """
         dict = copy.copy(self.__dict__)
         del dict["_debug"]
+        del dict["_function"]
         return dict
 
     def __setstate__(self, dict):
         """ Used by pickle when the class is unserialized.
-            Add the 'debug' attribute.
+            Add the 'debug' attribute. Templates precompiled before they
+            were compiled to Python are not uptodate.
             @hidden
         """
         dict["_debug"] = 0
+        dict["_function"] = None
+        dict.setdefault("_code", None)
+        dict.setdefault("_magic", None)
         self.__dict__ = dict
 
 
@@ -1414,3 +1760,10 @@ class PrecompiledError(Exception):
         """
         Exception.__init__(self, template)
 
+
+class UncompilableError(Exception):
+    """ This exception is _PRIVATE_ and non fatal.
+        Raised when a template cannot be compiled to a Python function.
+        @hidden
+    """
+    pass
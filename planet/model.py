@@ -0,0 +1,368 @@
+"""Template model.
+
+The channels and items handed to templates are dictionaries of template
+variables.  Building every variable for every item is wasteful when a
+template only uses a handful of them, so variables that are costly to
+produce are deferred until a template actually reads them.
+
+Gathering the model from a large cache takes a while, so the result is
+saved as a snapshot that later runs can reuse if its inputs are unchanged.
+"""
+
+import cPickle
+from hashlib import md5
+from htmlentitydefs import name2codepoint
+import os
+import re
+import time
+
+from .constants import TIMEFMT_ISO, TIMEFMT_822
+
+# Bump when the layout of the snapshot or of the model changes
+SNAPSHOT_VERSION = 4
+
+
+class TemplateInfo(dict):
+    """A dictionary of template variables.
+
+    Works like a normal dictionary, but a value can also be registered
+    with defer(), in which case it is computed on first access and then
+    kept, and dates can be registered with defer_date() to be formatted
+    on first access.  The keys of another TemplateInfo can be made
+    readable under a prefix with chain(), without copying them.
+
+    Anything that needs every value (items(), values(), copy()) computes
+    the deferred values and copies the chained ones first.  Pickling
+    computes the deferred values too, except for dates, which stay
+    unformatted, and keeps the chained TemplateInfo shared.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._deferred = {}
+        self._dates = []
+        self._chained = None
+
+    def defer(self, key, func, *args):
+        """Set key to func(*args), called when key is first read."""
+        self._forget(key)
+        self._deferred[key] = (func, args)
+
+    def defer_date(self, key, timestamp, date_format):
+        """Set the keys of a date, formatted when each is first read.
+
+        key is formatted with date_format, key_iso with TIMEFMT_ISO
+        and key_822 with TIMEFMT_822, timestamp is in UTC.
+        """
+        date = _LazyDate(key, timestamp, date_format)
+        for date_key in date.keys:
+            self._forget(date_key)
+        self._dates.append(date)
+
+    def chain(self, prefix, info):
+        """Make the keys of info readable as prefix + key.
+
+        The values are looked up in info whenever they are read, so any
+        number of dicts can share it.  Keys set on this dict take
+        precedence, and chained keys can't be deleted.
+        """
+        self._chained = (prefix, info)
+
+    def compute_deferred(self):
+        """Compute the values registered with defer()."""
+        for key in self._deferred.keys():
+            self[key]
+
+    def resolve(self):
+        """Compute all deferred values and copy the chained ones."""
+        for key in self._deferred.keys() + self._date_keys():
+            self[key]
+        for key in self._chained_keys():
+            dict.__setitem__(self, key, self[key])
+
+    def _forget(self, key):
+        """Remove key, wherever it is, returning whether it was there."""
+        if self._deferred.pop(key, None) is not None:
+            return True
+        for date in self._dates:
+            if date.forget(key):
+                return True
+        if dict.has_key(self, key):
+            dict.__delitem__(self, key)
+            return True
+        return False
+
+    def _date_keys(self):
+        """Return the keys of the dates that are yet to be formatted."""
+        return [key for date in self._dates for key in date.pending_keys()]
+
+    def _own_keys(self):
+        """Return the keys set or deferred on this dict itself."""
+        return dict.keys(self) + self._deferred.keys() + self._date_keys()
+
+    def _chained_keys(self):
+        """Return the chained keys that this dict doesn't have itself."""
+        if self._chained is None:
+            return []
+        prefix, info = self._chained
+        return [prefix + key for key in info.keys()
+                if not self._has_own(prefix + key)]
+
+    def _has_own(self, key):
+        """Return whether key is set or deferred on this dict itself."""
+        if dict.has_key(self, key) or key in self._deferred:
+            return True
+        for date in self._dates:
+            if date.is_pending(key):
+                return True
+        return False
+
+    def __missing__(self, key):
+        deferred = self._deferred.pop(key, None)
+        if deferred is not None:
+            func, args = deferred
+            value = func(*args)
+        else:
+            for date in self._dates:
+                if date.forget(key):
+                    value = date.format(key)
+                    break
+            else:
+                if self._chained is not None:
+                    prefix, info = self._chained
+                    if key.startswith(prefix) and key[len(prefix):] in info:
+                        return info[key[len(prefix):]]
+                raise KeyError(key)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._forget(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if not self._forget(key):
+            raise KeyError(key)
+
+    def has_key(self, key):
+        if self._has_own(key):
+            return True
+        if self._chained is not None:
+            prefix, info = self._chained
+            return key.startswith(prefix) and key[len(prefix):] in info
+        return False
+
+    __contains__ = has_key
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._own_keys() + self._chained_keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._deferred) + \
+            len(self._date_keys()) + len(self._chained_keys())
+
+    def items(self):
+        self.resolve()
+        return dict.items(self)
+
+    def iteritems(self):
+        self.resolve()
+        return dict.iteritems(self)
+
+    def values(self):
+        self.resolve()
+        return dict.values(self)
+
+    def itervalues(self):
+        self.resolve()
+        return dict.itervalues(self)
+
+    def copy(self):
+        self.resolve()
+        return type(self)(self)
+
+    def __reduce__(self):
+        self.compute_deferred()
+        return type(self), (dict(self),), self.__dict__
+
+
+# The keys of each date, shared by all the dates with the same key
+_date_keys = {}
+
+
+class _LazyDate(object):
+    """A date deferred by TemplateInfo.defer_date().
+
+    pending has a bit set for each of the keys that has not been
+    formatted or removed yet.
+    """
+
+    __slots__ = ("keys", "timestamp", "date_format", "pending")
+
+    def __init__(self, key, timestamp, date_format):
+        keys = _date_keys.get(key)
+        if keys is None:
+            keys = _date_keys[key] = (key, key + "_iso", key + "_822")
+        self.keys = keys
+        self.timestamp = timestamp
+        self.date_format = date_format
+        self.pending = 7
+
+    def is_pending(self, key):
+        """Return whether key is one of the pending keys."""
+        return key in self.keys and \
+            self.pending & (1 << self.keys.index(key)) != 0
+
+    def pending_keys(self):
+        """Return the pending keys."""
+        return [key for i, key in enumerate(self.keys)
+                if self.pending & (1 << i)]
+
+    def forget(self, key):
+        """Stop key pending, returning whether it was."""
+        if not self.is_pending(key):
+            return False
+        self.pending &= ~(1 << self.keys.index(key))
+        return True
+
+    def format(self, key):
+        """Return the date formatted for key, one of the date's keys."""
+        date_format = (self.date_format, TIMEFMT_ISO, TIMEFMT_822)[
+            self.keys.index(key)]
+        return time.strftime(date_format, time.gmtime(self.timestamp))
+
+    def __getstate__(self):
+        return self.keys, self.timestamp, self.date_format, self.pending
+
+    def __setstate__(self, state):
+        self.keys, self.timestamp, self.date_format, self.pending = state
+
+
+# A tag, comment or declaration, or a character or entity reference
+_markup = re.compile(r"<!--.*?-->|<[a-zA-Z/!?](?:[^>\"']|\"[^\"]*\"|'[^']*')*>"
+                     r"|&(?:#([0-9]+)|#[xX]([0-9a-fA-F]+)|([a-zA-Z][a-zA-Z0-9]*));?",
+                     re.DOTALL)
+
+
+def _replace_markup(match):
+    """Return the text for a match of _markup."""
+    decimal, hexadecimal, name = match.groups()
+    if decimal is not None:
+        codepoint = int(decimal)
+    elif hexadecimal is not None:
+        codepoint = int(hexadecimal, 16)
+    elif name is not None:
+        codepoint = name2codepoint.get(name)
+    else:
+        return ""
+    if codepoint is None or not 0 < codepoint < 0x110000:
+        # Not a character, so it can't have been meant as one
+        return match.group()
+    return unichr(codepoint).encode("utf8")
+
+
+def plain_text(html):
+    """Return the UTF-8 html with its tags removed and references decoded."""
+    if "<" not in html and "&" not in html:
+        return html
+    return _markup.sub(_replace_markup, html)
+
+
+def decoded(info, key):
+    """Return info[key], decoded from UTF-8 if it is a string."""
+    value = info[key]
+    if isinstance(value, str):
+        value = value.decode('utf8')
+    return value
+
+
+def unicode_view(info, views=None):
+    """Return a TemplateInfo with the values of info decoded from UTF-8.
+
+    Values are only looked up and decoded when they are read,
+    so deferred values of info stay deferred.  If info is chained to
+    another TemplateInfo the view is chained to a view of that one,
+    taken from views (a dict by id) if it has one, so dicts that share
+    a chained dict share the view of it too.
+    """
+    if views is None:
+        views = {}
+    view = TemplateInfo()
+    for key in info._own_keys():
+        view.defer(key, decoded, info, key)
+    if info._chained is not None:
+        prefix, chained = info._chained
+        chained_view = views.get(id(chained))
+        if chained_view is None:
+            chained_view = views[id(chained)] = unicode_view(chained, views)
+        view.chain(prefix, chained_view)
+    return view
+
+
+def unicode_lists(channels_list, items_list):
+    """Return unicode views of the channels_list and items_list.
+
+    The views are shared the way the dicts are, so each value of the
+    model is decoded at most once however many templates read it.
+    """
+    views = {}
+    channels = []
+    for info in channels_list:
+        view = views.get(id(info))
+        if view is None:
+            view = views[id(info)] = unicode_view(info, views)
+        channels.append(view)
+    items = [unicode_view(info, views) for info in items_list]
+    return channels, items
+
+
+def save_snapshot(filename, fingerprint, channels_list, items_list,
+                  expires=None, state=None):
+    """Save the gathered model to filename and return its serial.
+
+    fingerprint identifies the inputs the model was gathered from, and
+    state whatever else about the channels it depends on.  expires is
+    the time after which it is out of date anyway, if any.  The serial
+    is different for every snapshot saved.
+    """
+    serial = md5(repr((fingerprint, state, time.time()))).hexdigest()
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as snapshot:
+        cPickle.dump((SNAPSHOT_VERSION, serial, fingerprint, state, expires,
+                      channels_list, items_list),
+                     snapshot, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_filename, filename)
+    return serial
+
+
+def load_snapshot(filename, fingerprint, state=None):
+    """Return the (serial, channels_list, items_list) of a snapshot.
+
+    Returns None if there is no usable snapshot, or if it was saved
+    with a different fingerprint, or has expired.  The state is only
+    compared if one is given.
+    """
+    try:
+        with open(filename, "rb") as snapshot:
+            (version, serial, saved_fingerprint, saved_state, expires,
+             channels_list, items_list) = cPickle.load(snapshot)
+    except Exception:
+        return None
+    if version != SNAPSHOT_VERSION or saved_fingerprint != fingerprint:
+        return None
+    if state is not None and saved_state != state:
+        return None
+    if expires is not None and expires <= time.time():
+        return None
+    return serial, channels_list, items_list
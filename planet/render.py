@@ -1,15 +1,145 @@
+import cgi
+import codecs
+import cPickle
+import gzip
+from hashlib import sha1
 import logging
 import os
+import re
+import shutil
 import time
 
 import jinja2
+import jinja2.meta
 
-from . import htmltmpl
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from . import htmltmpl, model
 from .constants import TIMEFMT_ISO, TIMEFMT_822, VERSION
 
 
 log = logging.getLogger(__name__)
 
+# Template variables holding the time the template is rendered at
+TIME_VARS = ("date", "date_iso", "date_822")
+
+# Extensions of the template files rendered by Jinja, rather than htmltmpl
+JINJA_EXTENSIONS = ('.html', '.xml')
+
+# Extensions of the compressed copies of outputs, see compress_output()
+GZIP_EXTENSION = ".gz"
+BROTLI_EXTENSION = ".br"
+
+# Jinja environments, by search path and bytecode cache directory
+_jinja_environments = {}
+
+# htmltmpl template managers, by precompiled template directory
+_htmltmpl_managers = {}
+
+# The render_template() arguments of a worker process, see init_worker()
+_worker_args = None
+
+# htmltmpl tags, in either <TMPL_X> or <!-- TMPL_X --> form
+re_htmltmpl_tag = re.compile(r'<(?:!--\s*)?(/?)TMPL_(\w+)([^>]*?)(?:\s*--)?>',
+                             re.I)
+
+
+def output_name(template_file):
+    """Return the name of the file rendered from template_file."""
+    base = os.path.basename(template_file)
+    # Templates may be '.html' or '.html.tmpl', etc.
+    # Don't throw away the last extension.
+    if base.count('.') > 1:
+        base = os.path.splitext(base)[0]
+    return base
+
+
+def uses_time(template_file):
+    """Return whether template_file shows the time it was rendered at.
+
+    That is whether it uses any of TIME_VARS, or might do so because
+    it includes other templates or can't be read.
+    """
+    try:
+        with open(template_file) as f:
+            source = f.read()
+    except IOError:
+        return True
+    if template_file.endswith('.tmpl'):
+        return _htmltmpl_uses_time(source)
+    # Analysed with the same filters as rendered, as compiling the
+    # template to find its variables fails on any it doesn't know.
+    env = new_jinja_environment()
+    try:
+        ast = env.parse(source.decode('utf8'))
+        if list(jinja2.meta.find_referenced_templates(ast)):
+            return True
+        variables = jinja2.meta.find_undeclared_variables(ast)
+    except (jinja2.TemplateError, UnicodeError):
+        return True
+    return bool(variables & set(TIME_VARS))
+
+
+def _htmltmpl_uses_time(source):
+    depth = 0
+    for close, tag, params in re_htmltmpl_tag.findall(source):
+        tag = tag.upper()
+        if tag == "INCLUDE":
+            return True
+        elif tag == "LOOP":
+            depth += close and -1 or 1
+        elif tag == "VAR":
+            names = []
+            is_global = False
+            for param in params.split():
+                name, _, value = param.rpartition("=")
+                if name.upper() == "GLOBAL":
+                    is_global = value.strip("\"'") == "1"
+                elif not name or name.upper() == "NAME":
+                    names.append(value.strip("\"'"))
+            if (depth == 0 or is_global) and \
+                   any(name in TIME_VARS for name in names):
+                return True
+    return False
+
+
+def render_key(template_file, output_file, serial, precompress=False):
+    """Return what rendering template_file to output_file depends on.
+
+    That includes whether compressed copies of output_file are made.
+    Returns None if that can't be told, because the template can't be
+    found or the model has no snapshot serial.
+
+    Only template_file itself is stat'ed, not the templates it includes,
+    so the key is only enough to skip a template if uses_time() is False
+    for it, which it never is for templates that include others.
+    """
+    if serial is None:
+        return None
+    try:
+        stat = os.stat(template_file)
+    except OSError:
+        return None
+    return serial, stat.st_mtime, stat.st_size, output_file, bool(precompress)
+
+
+def load_record(filename):
+    """Return the record of what each template was rendered from."""
+    try:
+        with open(filename, "rb") as f:
+            return cPickle.load(f)
+    except Exception:
+        return {}
+
+
+def save_record(filename, record):
+    """Save the record of what each template was rendered from."""
+    with open(filename, "wb") as f:
+        cPickle.dump(record, f, cPickle.HIGHEST_PROTOCOL)
+
 
 def render_template(
         template_file,
@@ -18,20 +148,28 @@ def render_template(
         encoding,
         channels_list,
         items_list,
-        planet_kwargs):
+        planet_kwargs,
+        search_path=(),
+        compiled_directory=None,
+        unicode_lists=None,
+        precompress=False):
     """Render a template file.
     Chooses renderer based on template_file extension.
 
     :param planet_kwargs: Extra Planet-level parameters in the config.
+    :param unicode_lists: The (channels, items) unicode views of
+        channels_list and items_list for Jinja templates, as returned by
+        model.unicode_lists(), to share them between templates.
+    :param search_path: Other directories Jinja templates can include
+        or extend templates from.
+    :param compiled_directory: Where to keep compiled templates.
+    :param precompress: Whether to keep compressed copies of the output
+        next to it, see compress_output().
     """
     log.info("Processing template %s", template_file)
     
     # We treat each template individually
-    base = os.path.basename(template_file)
-    # Templates may be '.html' or '.html.tmpl', etc.
-    # Don't throw away the last extension.
-    if base.count('.') > 1:
-        base = os.path.splitext(base)[0]
+    base = output_name(template_file)
     url = os.path.join(planet_kwargs['link'], base).replace('\\', '/')
     output_file = os.path.join(output_dir, base)
     
@@ -50,29 +188,201 @@ def render_template(
     kwargs['feedtype'] = kwargs['feed'].find('rss')>=0 and 'rss' or 'atom'
 
     if template_file.endswith('.tmpl'):
-        func = render_htmltmpl
+        chunks = render_htmltmpl(template_file, kwargs, compiled_directory)
     else:
-        assert template_file.endswith('.html')
-        func = render_jinja
-    html = func(template_file, kwargs)
+        assert template_file.endswith(JINJA_EXTENSIONS)
+        if unicode_lists is None:
+            unicode_lists = model.unicode_lists(channels_list, items_list)
+        # Jinja wants unicode, and the Planet-level values are UTF-8 too
+        for key in kwargs:
+            kwargs[key] = model.decoded(kwargs, key)
+        kwargs['Channels'], kwargs['Items'] = unicode_lists
+        chunks = render_jinja(template_file, kwargs, search_path,
+                              compiled_directory)
 
     log.info("Writing %s", output_file)
-    with open(output_file, "w") as output_fd:
-        if encoding.lower() in ("utf-8", "utf8"):
-            # UTF-8 output is the default because we use that internally
-            output_fd.write(html)
-        elif encoding.lower() in ("xml", "html", "sgml"):
-            # Magic for Python 2.3 users
-            output = html.decode("utf-8")
-            output_fd.write(output.encode("ascii", "xmlcharrefreplace"))
-        else:
-            # Must be a "known" encoding
-            output = html.decode("utf-8")
-            output_fd.write(output.encode(encoding, "replace"))
-
-
-def render_htmltmpl(template_file, template_kwargs):
-    manager = htmltmpl.TemplateManager()
+    changed = write_output(output_file, chunks, encoding)
+    if not changed:
+        log.info("%s is unchanged", output_file)
+    if precompress:
+        compress_output(output_file, changed)
+    elif changed:
+        # Copies of the old output would be served instead of the new one
+        for extension in GZIP_EXTENSION, BROTLI_EXTENSION:
+            remove_file(output_file + extension)
+
+
+def write_output(output_file, chunks, encoding):
+    """Write the chunks a template was rendered in to output_file.
+
+    The chunks are UTF-8 strings or unicode, and are encoded as they
+    come, so the output never has to be in memory all at once.  An
+    encoding of "xml", "html" or "sgml" means ASCII, with character
+    references for everything else.  The output goes to a temporary
+    file first, which only replaces output_file once it is complete,
+    and only if it is different, so an unchanged output_file keeps its
+    modification time.
+
+    Returns whether output_file was replaced.
+    """
+    encoding = encoding.lower()
+    if encoding in ("utf-8", "utf8"):
+        # UTF-8 output is the default because we use that internally
+        encoder = None
+    elif encoding in ("xml", "html", "sgml"):
+        encoder = codecs.getincrementalencoder("ascii")("xmlcharrefreplace")
+    else:
+        # Must be a "known" encoding
+        encoder = codecs.getincrementalencoder(encoding)("replace")
+    decoder = codecs.getincrementaldecoder("utf-8")()
+
+    tmp_file = output_file + ".tmp"
+    digest = sha1()
+    try:
+        with open(tmp_file, "w") as output_fd:
+            for chunk in chunks:
+                if encoder is None:
+                    if isinstance(chunk, unicode):
+                        chunk = chunk.encode("utf-8")
+                else:
+                    if isinstance(chunk, str):
+                        chunk = decoder.decode(chunk)
+                    chunk = encoder.encode(chunk)
+                digest.update(chunk)
+                output_fd.write(chunk)
+            if encoder is not None:
+                chunk = encoder.encode(decoder.decode("", True), True)
+                digest.update(chunk)
+                output_fd.write(chunk)
+        if os.path.isfile(output_file):
+            if os.path.getsize(output_file) == os.path.getsize(tmp_file) \
+                   and file_digest(output_file) == digest.digest():
+                os.remove(tmp_file)
+                return False
+            # Keep the permissions of the output being replaced
+            shutil.copymode(output_file, tmp_file)
+        os.rename(tmp_file, output_file)
+    except:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return True
+
+
+def compress_output(output_file, changed=True):
+    """Keep compressed copies of output_file next to it.
+
+    There is a gzip copy, and a brotli one if the brotli module is
+    available, both at the highest compression level, so that web
+    servers can serve them as they are (nginx's gzip_static, say)
+    rather than compress output_file for every request.  Copies are
+    only made again if output_file changed, or if they are missing, and
+    have the same permissions as output_file.
+    """
+    mtime = os.path.getmtime(output_file)
+    gzip_file = output_file + GZIP_EXTENSION
+    if changed or not os.path.isfile(gzip_file):
+        tmp_file = gzip_file + ".tmp"
+        try:
+            with open(output_file, "rb") as f:
+                with open(tmp_file, "wb") as compressed:
+                    gzip_fd = gzip.GzipFile("", "wb", 9, compressed, mtime)
+                    for block in iter(lambda: f.read(65536), ""):
+                        gzip_fd.write(block)
+                    gzip_fd.close()
+            shutil.copymode(output_file, tmp_file)
+            os.utime(tmp_file, (mtime, mtime))
+            os.rename(tmp_file, gzip_file)
+        except:
+            remove_file(tmp_file)
+            raise
+    brotli_file = output_file + BROTLI_EXTENSION
+    if brotli is None:
+        # Don't leave a copy of an older output behind
+        if changed:
+            remove_file(brotli_file)
+    elif changed or not os.path.isfile(brotli_file):
+        tmp_file = brotli_file + ".tmp"
+        try:
+            with open(output_file, "rb") as f:
+                data = brotli.compress(f.read(), quality=11)
+            with open(tmp_file, "wb") as compressed:
+                compressed.write(data)
+            shutil.copymode(output_file, tmp_file)
+            os.utime(tmp_file, (mtime, mtime))
+            os.rename(tmp_file, brotli_file)
+        except:
+            remove_file(tmp_file)
+            raise
+
+
+def remove_file(filename):
+    """Remove filename if it exists."""
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def file_digest(filename):
+    """Return the SHA-1 digest of the content of filename."""
+    digest = sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(65536), ""):
+            digest.update(block)
+    return digest.digest()
+
+
+def try_render_template(template_file, *args):
+    """Render template_file with render_template(), and log any failure.
+
+    Returns whether the template was rendered.
+    """
+    try:
+        render_template(template_file, *args)
+    except Exception:
+        log.exception('Write failed for %s', template_file)
+        return False
+    return True
+
+
+def init_worker(args):
+    """Set up a worker process to render templates with args.
+
+    args are the render_template() arguments after the template file,
+    given once for all the templates the process renders.
+    """
+    global _worker_args
+    _worker_args = args
+
+
+def render_in_worker(template_file):
+    """Render template_file in a worker process set up by init_worker()."""
+    return try_render_template(template_file, *_worker_args)
+
+
+def htmltmpl_manager(precompile_directory=None):
+    """Return the shared htmltmpl template manager.
+
+    Templates it prepares are kept for as long as the process runs.
+    They are also kept precompiled in precompile_directory if there is
+    one, or otherwise next to the template files, so later runs needn't
+    compile them again either.
+    """
+    manager = _htmltmpl_managers.get(precompile_directory)
+    if manager is None:
+        if precompile_directory is not None and \
+               not os.path.isdir(precompile_directory):
+            os.makedirs(precompile_directory)
+        manager = _htmltmpl_managers[precompile_directory] = \
+            htmltmpl.TemplateManager(precompile_dir=precompile_directory)
+    return manager
+
+
+def render_htmltmpl(template_file, template_kwargs, precompile_directory=None):
+    """Render an htmltmpl template.
+
+    Returns a generator of the rendered chunks.
+    """
+    manager = htmltmpl_manager(precompile_directory)
     try:
         template = manager.prepare(template_file)
     except htmltmpl.TemplateError:
@@ -83,22 +393,57 @@ def render_htmltmpl(template_file, template_kwargs):
     for key, val in template_kwargs.iteritems():
         tp.set(key, val)
 
-    return tp.process(template)
-
-
-def render_jinja(template_file, template_kwargs):
-    for key in 'Items', 'Channels':
-        newobjs = []
-        for oldobj in template_kwargs[key]:
-            newobj = {}
-            for k, v in oldobj.iteritems():
-                if isinstance(v, str):
-                    v = v.decode('utf8')
-                newobj[k] = v
-            newobjs.append(newobj)
-        template_kwargs[key] = newobjs
-
-    with open(template_file) as f:
-        template = jinja2.Template(f.read())
-    html = template.render(**template_kwargs)
-    return html.encode('utf8')
+    return tp.generate(template)
+
+
+def jinja_environment(search_path, bytecode_directory=None):
+    """Return the shared Jinja environment for search_path.
+
+    Templates are loaded from the directories in search_path, in order,
+    and kept compiled for as long as the process runs.  If there is a
+    bytecode_directory they are kept compiled there too, so later runs
+    needn't compile them again either.
+    """
+    key = (tuple(search_path), bytecode_directory)
+    env = _jinja_environments.get(key)
+    if env is None:
+        bytecode_cache = None
+        if bytecode_directory is not None:
+            if not os.path.isdir(bytecode_directory):
+                os.makedirs(bytecode_directory)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_directory)
+        env = _jinja_environments[key] = new_jinja_environment(
+            loader=jinja2.FileSystemLoader(list(search_path)),
+            bytecode_cache=bytecode_cache)
+    return env
+
+
+def new_jinja_environment(**kwargs):
+    """Return a new Jinja environment with the planet's own filters."""
+    env = jinja2.Environment(**kwargs)
+    env.filters['escape_html'] = escape_html
+    return env
+
+
+def escape_html(value):
+    """Escape value the way htmltmpl's ESCAPE="HTML" does.
+
+    That is, unlike Jinja's escape filter, leave single quotes alone,
+    so the bundled feed templates come out the same with either engine.
+    """
+    return cgi.escape(unicode(value), True)
+
+
+def render_jinja(template_file, template_kwargs, search_path=(),
+                 bytecode_directory=None):
+    """Render a Jinja template, with Items and Channels in unicode.
+
+    Returns a generator of the rendered chunks.
+    """
+    # The template's own directory comes first, so it is found there
+    directory = os.path.dirname(template_file) or os.curdir
+    search_path = [directory] + [path for path in search_path
+                                 if path != directory]
+    env = jinja_environment(search_path, bytecode_directory)
+    template = env.get_template(os.path.basename(template_file))
+    return template.generate(**template_kwargs)
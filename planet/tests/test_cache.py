@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+
+from cStringIO import StringIO
+import dbhash
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import planet
+from planet import __main__, cache
+from planet.constants import REQUIRED_OPTIONS
+
+
+class DictCache(dict):
+    """A dict that can stand in for a dbhash cache file."""
+
+    def sync(self):
+        pass
+
+
+class CountingCache(DictCache):
+    """A DictCache that counts how often it is synced."""
+
+    syncs = 0
+
+    def sync(self):
+        self.syncs += 1
+
+    def close(self):
+        pass
+
+
+class CachedInfoTest(unittest.TestCase):
+    """
+    Test CachedInfo storage and its round trip through the cache.
+    """
+
+    def setUp(self):
+        self.store = DictCache()
+        self.info = cache.CachedInfo(self.store, "http://example.com/1")
+        self.date = time.gmtime(1400000000)
+
+    def test_access(self):
+        self.info.title = "A title"
+        self.info["link"] = u"http://example.com/\xe9"
+        self.info.set_as_date("updated", self.date)
+        self.info.author = None
+        self.assertEqual(self.info.title, "A title")
+        self.assertEqual(self.info["link"], "http://example.com/\xc3\xa9")
+        self.assertEqual(self.info.updated, tuple(self.date))
+        self.assertEqual(self.info.author, None)
+        self.assertEqual(self.info.key_type("updated"), cache.CachedInfo.DATE)
+        self.assertEqual(self.info.key_type("author"), cache.CachedInfo.NULL)
+        self.assertEqual(sorted(self.info.keys()),
+                         ["author", "link", "title", "updated"])
+        self.assertTrue("title" in self.info)
+        del self.info["title"]
+        self.assertFalse(self.info.has_key("title"))
+        self.assertRaises(AttributeError, getattr, self.info, "title")
+        self.assertRaises(KeyError, self.info.get, "title")
+
+    def test_shared_layout(self):
+        other = cache.CachedInfo(self.store, "http://example.com/2")
+        for info in self.info, other:
+            info.title = "A title"
+            info.link = "http://example.com/"
+        self.assertTrue(self.info._layout is other._layout)
+        self.assertEqual(self.info.keys(), ["title", "link"])
+
+        del other["title"]
+        other.title = "Another title"
+        self.assertEqual(other.keys(), ["link", "title"])
+        self.assertEqual(other.title, "Another title")
+        self.assertEqual(other.link, "http://example.com/")
+        self.assertEqual(self.info.title, "A title")
+        self.assertEqual(self.info.link, "http://example.com/")
+
+    def test_round_trip(self):
+        self.info.title = "A title"
+        self.info.set_as_date("updated", self.date)
+        self.info.set_as_string("hidden", "yes", cached=0)
+        self.info.cache_write()
+        self.assertFalse(self.store.has_key("http://example.com/1 hidden"))
+
+        other = cache.CachedInfo(self.store, "http://example.com/1")
+        other.cache_read()
+        self.assertEqual(sorted(other.keys()), ["title", "updated"])
+        self.assertEqual(other.title, "A title")
+        self.assertEqual(other.updated, tuple(self.date))
+
+    def test_compressed_round_trip(self):
+        content = "<p>%s</p>" % ("content " * 200)
+        self.info.content = content
+        self.info.summary = "short"
+        self.assertTrue(self.info.is_compressed("content"))
+        self.assertFalse(self.info.is_compressed("summary"))
+        self.assertEqual(self.info.key_type("content"), cache.CachedInfo.STRING)
+        self.assertEqual(self.info.content, content)
+        self.info.cache_write()
+        self.assertEqual(self.store["http://example.com/1 content type"],
+                         cache.CachedInfo.ZLIB)
+        self.assertTrue(len(self.store["http://example.com/1 content"]) <
+                        len(content))
+
+        other = cache.CachedInfo(self.store, "http://example.com/1")
+        other.cache_read()
+        self.assertTrue(other.is_compressed("content"))
+        self.assertEqual(other["content"], content)
+
+    def test_derived(self):
+        calls = []
+        def upper(value):
+            calls.append(value)
+            return value.upper()
+        self.info.title = "a title"
+        self.assertEqual(self.info.get_derived("loud", "title", upper),
+                         "A TITLE")
+        self.assertEqual(self.info.get_derived("loud", "title", upper),
+                         "A TITLE")
+        self.assertEqual(calls, ["a title"])
+
+        # Kept in the cache, until the source changes
+        self.info.cache_write()
+        other = cache.CachedInfo(self.store, "http://example.com/1")
+        other.cache_read()
+        self.assertEqual(other.get_derived("loud", "title", upper), "A TITLE")
+        self.assertEqual(calls, ["a title"])
+        other.title = "another"
+        self.assertEqual(other.get_derived("loud", "title", upper), "ANOTHER")
+        self.assertEqual(calls, ["a title", "another"])
+
+    def test_uncached_values_are_kept(self):
+        self.info.title = "Cached"
+        self.info.cache_write()
+        self.info.set_as_string("title", "Configured", cached=0)
+        self.info.cache_read()
+        self.assertEqual(self.info.title, "Configured")
+
+
+class GroupWriterTest(unittest.TestCase):
+    """
+    Test that CacheFile changes reach the disk only when committed
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "channel")
+        self.writer = cache.GroupWriter()
+        self.cache_file = cache.CacheFile(self.filename, self.writer)
+
+    def tearDown(self):
+        self.cache_file.close()
+        shutil.rmtree(self.directory)
+
+    def on_disk(self):
+        if not os.path.exists(self.filename):
+            return {}
+        disk = dbhash.open(self.filename, "r")
+        try:
+            return dict(disk.iteritems())
+        finally:
+            disk.close()
+
+    def test_group_commit(self):
+        self.cache_file["a"] = "1"
+        self.cache_file["b"] = "2"
+        self.cache_file.sync()
+        del self.cache_file["b"]
+        self.assertEqual(self.cache_file["a"], "1")
+        self.assertFalse(self.cache_file.has_key("b"))
+        self.assertEqual(self.cache_file.keys(), ["a"])
+        self.assertEqual(self.on_disk(), {})
+
+        self.writer.commit()
+        self.assertEqual(self.on_disk(), {"a": "1", "b": "2"})
+        self.assertEqual(self.writer.changes, 2)
+
+    def test_unchanged_values_are_dropped(self):
+        self.cache_file["a"] = "1"
+        self.cache_file.sync()
+        self.writer.commit()
+        self.cache_file["a"] = "1"
+        self.cache_file["b"] = "2"
+        del self.cache_file["b"]
+        self.cache_file.sync()
+        self.assertEqual(self.cache_file.changes, 1)
+        self.assertEqual(self.writer.changes, 1)
+
+    def test_commit_every(self):
+        self.writer.commit_every = 2
+        self.cache_file["a"] = "1"
+        self.cache_file.sync()
+        self.assertEqual(self.on_disk(), {})
+        self.cache_file["b"] = "2"
+        self.cache_file.sync()
+        self.assertEqual(self.on_disk(), {"a": "1", "b": "2"})
+
+
+    def test_recover(self):
+        other = cache.CacheFile(os.path.join(self.directory, "other"),
+                                self.writer)
+        for cache_file in self.cache_file, other:
+            cache_file["a"] = "1"
+            cache_file["b"] = "2"
+            cache_file.sync()
+
+        # A crash after the first file and a key of the second
+        write_changes = cache._write_changes
+        written = []
+        def crash(db, changes):
+            for key, value in sorted(changes.items()):
+                if len(written) == 3:
+                    raise KeyboardInterrupt
+                db[key] = value
+                written.append(key)
+        cache._write_changes = crash
+        try:
+            self.assertRaises(KeyboardInterrupt, self.writer.commit)
+        finally:
+            cache._write_changes = write_changes
+        self.assertEqual(self.on_disk(), {"a": "1", "b": "2"})
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory, cache.GROUP_JOURNAL)))
+
+        # The next run finishes the commit
+        other._file.close()
+        self.assertEqual(cache.recover(self.directory), 1)
+        disk = dbhash.open(other.filename, "r")
+        try:
+            self.assertEqual(dict(disk.iteritems()), {"a": "1", "b": "2"})
+        finally:
+            disk.close()
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["channel", "other"])
+        self.assertEqual(cache.recover(self.directory), 0)
+
+    def test_commit_without_writer(self):
+        cache_file = cache.CacheFile(os.path.join(self.directory, "alone"))
+        cache_file["a"] = "1"
+        cache_file.sync()
+        self.assertEqual(sorted(os.listdir(self.directory)), ["alone"])
+        cache_file.close()
+
+        # An unfinished journal was never committed
+        with open(os.path.join(self.directory,
+                               "alone.journal.tmp"), "w") as f:
+            f.write("partial")
+        self.assertEqual(cache.recover(self.directory), 0)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["alone"])
+
+    def test_one_sync_per_file(self):
+        caches = [cache.CacheFile(os.path.join(self.directory, name),
+                                  self.writer)
+                  for name in ("blobs", "one", "two")]
+        for cache_file in caches:
+            cache_file._file = CountingCache()
+        blobs = caches[0]
+        for cache_file in caches[1:]:
+            for value in ("1", "2"):
+                blobs[value] = value
+                blobs.sync()
+                cache_file["a"] = value
+                cache_file.sync()
+        self.assertEqual([c._file.syncs for c in caches], [0, 0, 0])
+        self.writer.commit()
+        self.assertEqual([c._file.syncs for c in caches], [1, 1, 1])
+        self.assertEqual(self.writer.commits, 1)
+
+        # Without a writer every batch is synced on its own
+        cache_file = cache.CacheFile(os.path.join(self.directory, "three"))
+        cache_file._file = CountingCache()
+        for value in ("1", "2"):
+            cache_file["a"] = value
+            cache_file.sync()
+        self.assertEqual(cache_file._file.syncs, 2)
+
+
+class HandlePoolTest(unittest.TestCase):
+    """
+    Test that a HandlePool keeps few files open and reopens them
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pool = cache.HandlePool(2)
+        self.files = [cache.CacheFile(os.path.join(self.directory, name),
+                                      pool=self.pool)
+                      for name in "abc"]
+
+    def tearDown(self):
+        for cache_file in self.files:
+            cache_file.close()
+        shutil.rmtree(self.directory)
+
+    def test_reopen(self):
+        for cache_file in self.files:
+            cache_file["key"] = cache_file.filename
+            cache_file.sync()
+        self.assertEqual(self.pool.peak, 2)
+        self.assertEqual(self.pool.reopens, 0)
+        self.assertEqual(self.files[0]._file, None)
+
+        for cache_file in self.files:
+            self.assertEqual(cache_file["key"], cache_file.filename)
+        self.assertEqual(self.pool.peak, 2)
+        self.assertEqual(self.pool.opens, 6)
+        self.assertEqual(self.pool.reopens, 3)
+
+
+class BlobStoreTest(unittest.TestCase):
+    """
+    Test the content-addressed BlobStore
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.blobs = cache.BlobStore(self.directory)
+        self.body = "<p>%s</p>" % ("body " * 200)
+
+    def tearDown(self):
+        self.blobs.close()
+        shutil.rmtree(self.directory)
+
+    def test_shared_bodies(self):
+        blobs = self.blobs
+        class BlobInfo(cache.CachedInfo):
+            def blob_store(self):
+                return blobs
+
+        store = DictCache()
+        items = []
+        for id_ in "http://a/1", "http://b/1":
+            info = BlobInfo(store, id_)
+            info.content = self.body
+            info.cache_write()
+            items.append(info)
+        digest = store["http://a/1 content"]
+        self.assertEqual(store["http://a/1 content type"], cache.CachedInfo.BLOB)
+        self.assertEqual(store["http://b/1 content"], digest)
+        self.assertTrue(items[0].is_compressed("content"))
+        self.assertEqual(items[1].content, self.body)
+
+    def test_sanitize_is_reused(self):
+        calls = []
+        def sanitize(value):
+            calls.append(value)
+            return value.upper()
+        self.assertEqual(self.blobs.sanitize(self.body, sanitize),
+                         self.body.upper())
+        self.assertEqual(self.blobs.sanitize(self.body, sanitize),
+                         self.body.upper())
+        self.assertEqual(len(calls), 1)
+
+    def test_collect(self):
+        kept = self.blobs.put(self.body)
+        self.blobs.put(self.body + "gone")
+        self.assertEqual(self.blobs.collect(set([kept])), 1)
+        self.assertEqual(self.blobs.get(kept), self.body)
+
+
+class PlanetCacheTest(unittest.TestCase):
+    """
+    Base for tests of the cache of a whole planet
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_directory = os.path.join(self.directory, "cache")
+        self.config_file = os.path.join(self.directory, "config.ini")
+        self.write_config()
+        my_planet = planet.Planet(__main__.read_config(self.config_file))
+        my_planet.configure_cache()
+        channel = planet.Channel(my_planet, "http://example.com/feed")
+        channel.updated = time.gmtime(1400000000)
+        for i in range(3):
+            item = planet.NewsItem(channel, "http://example.com/%d" % i)
+            item.title = "Item <b>%d</b>" % i
+            item.set_as_date("date", time.gmtime(1400000000 - i * 3600))
+            channel._items[item.id] = item
+        channel.cache_write()
+        channel._cache.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_config(self, **options):
+        with open(self.config_file, "w") as f:
+            f.write("[Planet]\n")
+            for option in REQUIRED_OPTIONS:
+                f.write("%s = x\n" % option)
+            f.write("cache_directory = %s\n" % self.cache_directory)
+            for option, value in options.items():
+                f.write("%s = %s\n" % (option, value))
+            f.write("[http://example.com/feed]\nname = Example\n")
+            f.write("[http://example.com/missing]\nname = Missing\n")
+
+
+class CacheCommandTest(PlanetCacheTest):
+    """
+    Test examining the cache from the command line
+    """
+
+    def run_command(self, *args):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            status = cache.main((self.config_file,) + args)
+            return status, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_channels(self):
+        before = sorted(os.listdir(self.cache_directory))
+        status, output = self.run_command("channels")
+        self.assertFalse(status)
+        lines = output.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].split()[0] == "3")
+        self.assertTrue(lines[1].endswith("Example <http://example.com/feed>"))
+        # The channel without a cache is left alone
+        self.assertEqual(sorted(os.listdir(self.cache_directory)), before)
+
+        self.write_config(load_processes=2)
+        self.assertEqual(self.run_command("channels"), (status, output))
+
+    def test_dump(self):
+        status, output = self.run_command("dump", "http://example.com/1")
+        self.assertFalse(status)
+        self.assertTrue("Channel: Example <http://example.com/feed>" in output)
+        self.assertTrue("title                string  Item <b>1</b>\n"
+                        in output)
+        self.assertTrue("date                 date    2014-05-13T15:53:20\n"
+                        in output)
+
+        status, output = self.run_command("dump", "http://example.com/9")
+        self.assertEqual(status, 1)
+
+
+class CompactTest(PlanetCacheTest):
+    """
+    Test rewriting cache files to drop dead space
+    """
+
+    def records(self, filename):
+        cache_file = dbhash.open(filename, "r")
+        try:
+            return dict(cache_file.iteritems())
+        finally:
+            cache_file.close()
+
+    def test_compact(self):
+        filename = cache.filename(self.cache_directory,
+                                  "http://example.com/feed")
+        my_planet = planet.Planet(__main__.read_config(self.config_file))
+        my_planet.configure_cache()
+        channel = planet.Channel(my_planet, "http://example.com/feed")
+        for i in range(2):
+            channel.get_item("http://example.com/%d" % i).cache_clear()
+        channel._cache.close()
+        records = self.records(filename)
+        stat = os.stat(filename)
+
+        results = my_planet.compact_cache()
+        self.assertEqual([result[0] for result in results], [filename])
+        self.assertEqual(results[0][1:3],
+                         (stat.st_size, os.path.getsize(filename)))
+        # A new file replaced the old one
+        self.assertNotEqual(os.stat(filename).st_ino, stat.st_ino)
+        self.assertEqual(self.records(filename), records)
+        self.assertFalse(os.path.exists(filename + ".compact"))
+
+    def test_command(self):
+        filename = cache.filename(self.cache_directory,
+                                  "http://example.com/feed")
+        records = self.records(filename)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            __main__.main(["compact", self.config_file])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(output.startswith("Compacted 1 cache files from "))
+        self.assertEqual(self.records(filename), records)
+        self.assertEqual(os.listdir(self.cache_directory),
+                         [os.path.basename(filename)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
+import os
+import shutil
 import unittest
 import tempfile
+import time
 import ConfigParser
 
 import planet
+from planet import cache
 
 
 class FakePlanet(object):
@@ -16,6 +20,9 @@ class FakePlanet(object):
     def __init__(self):
         self.cache_directory = tempfile.gettempdir()
         self.config = ConfigParser.ConfigParser()
+        self.cache_max_items = 0
+        self.cache_max_age = 0
+        self.cache_keep_ids = set()
 
 class FeedInformationTest(unittest.TestCase):
     """
@@ -36,5 +43,194 @@ class FeedInformationTest(unittest.TestCase):
         self.assertEqual(self.channel.feed_information(),
            "<%s> (formerly <%s>)" % (self.changed_url, self.url))
 
+class ExpireItemsTest(unittest.TestCase):
+    """
+    Test the Channel.expire_items retention policy
+    """
+
+    def setUp(self):
+        self.planet = FakePlanet()
+        self.channel = planet.Channel(self.planet, 'Retention URL')
+        now = time.time()
+        for i in range(10):
+            item = planet.NewsItem(self.channel, 'item%d' % i)
+            item.set_as_date('date', time.gmtime(now - i * 86400 - 60))
+            item.order = str(i)
+            self.channel._items[item.id] = item
+
+    def remaining(self):
+        return sorted(item.id for item in self.channel.items(hidden=True))
+
+    def test_no_policy(self):
+        self.channel.expire_items()
+        self.assertEqual(len(self.remaining()), 10)
+
+    def test_max_items(self):
+        self.planet.cache_max_items = 5
+        self.channel.expire_items()
+        self.assertEqual(self.remaining(), ['item%d' % i for i in range(5)])
+        self.assertEqual(len(self.channel._expired), 5)
+
+    def test_max_age(self):
+        self.planet.cache_max_age = 6
+        self.channel.expire_items()
+        self.assertEqual(self.remaining(), ['item%d' % i for i in range(6)])
+
+    def test_keeps_the_newest_of_the_planet(self):
+        self.planet.cache_max_items = 1
+        self.planet.cache_max_age = 1
+        self.planet.cache_keep_ids = set(['item4', 'item7'])
+        self.channel.expire_items()
+        self.assertEqual(self.remaining(), ['item0', 'item4', 'item7'])
+
+
+class KeepNewestItemsTest(unittest.TestCase):
+    """
+    Test working out the newest items of the planet, which are kept
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = ConfigParser.ConfigParser()
+        config.add_section('Planet')
+        self.planet = planet.Planet(config)
+        self.planet.cache_directory = self.directory
+        self.planet.cache_keep_items = 3
+        now = time.time()
+        for name, ages in ('one', (1, 2, 6)), ('two', (3, 4, 5)):
+            channel = planet.Channel(self.planet, name)
+            for age in ages:
+                item = planet.NewsItem(channel, '%s%d' % (name, age))
+                item.set_as_date('date', time.gmtime(now - age * 86400))
+                item.order = '0'
+                channel._items[item.id] = item
+            self.planet.subscribe(channel)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_policy(self):
+        self.planet.keep_newest_items()
+        self.assertEqual(self.planet.cache_keep_ids, set())
+
+    def test_newest(self):
+        self.planet.cache_max_items = 1
+        self.planet.keep_newest_items()
+        self.assertEqual(self.planet.cache_keep_ids,
+                         set(['one1', 'one2', 'two3']))
+        for channel in self.planet.channels():
+            channel.expire_items()
+        self.assertEqual(sorted(item.id for item in self.planet.items()),
+                         ['one1', 'one2', 'two3'])
+
+class LatestDateTest(unittest.TestCase):
+    """
+    Test the latest_date kept with each channel
+    """
+
+    def setUp(self):
+        self.channel = planet.Channel(FakePlanet(), 'Latest URL')
+        self.dates = [time.gmtime(1400000000 + i * 3600) for i in range(3)]
+        for i, date in enumerate(self.dates):
+            item = planet.NewsItem(self.channel, 'item%d' % i)
+            item.set_as_date('date', date)
+            item.order = str(i)
+            self.channel._items[item.id] = item
+
+    def test_worked_out_once(self):
+        self.assertFalse(self.channel.has_key('latest_date'))
+        self.assertEqual(self.channel.get('latest_date'), self.dates[2])
+        self.channel._items.clear()
+        self.assertEqual(self.channel.get('latest_date'), self.dates[2])
+
+    def test_follows_items(self):
+        self.channel.get('latest_date')
+        item = self.channel.get_item('item1')
+        newer = time.gmtime(1400000000 + 5 * 3600)
+        item.set_as_date('date', newer)
+        self.channel._item_date_changed(item, self.dates[1], newer)
+        self.assertEqual(self.channel.get('latest_date'), newer)
+
+        del self.channel._items['item1']
+        self.channel._item_date_changed(item, newer, None)
+        self.assertEqual(self.channel.get('latest_date'), self.dates[2])
+
+    def test_hidden_items(self):
+        for item in self.channel.items():
+            item.hidden = 'yes'
+        self.assertEqual(self.channel.get('latest_date'), None)
+
+
+class ReadRecordsTest(unittest.TestCase):
+    """
+    Test building a Channel from records read by cache.read_records
+    """
+
+    def setUp(self):
+        self.planet = FakePlanet()
+        self.planet.cache_directory = tempfile.mkdtemp()
+        channel = planet.Channel(self.planet, 'Records URL')
+        channel.name = 'Records'
+        for i in range(3):
+            item = planet.NewsItem(channel, 'item%d' % i)
+            item.title = 'Item %d' % i
+            item.set_as_date('date', time.gmtime(1400000000 + i))
+            channel._items[item.id] = item
+        channel.cache_write()
+
+    def tearDown(self):
+        shutil.rmtree(self.planet.cache_directory)
+
+    def test_same_as_cache_read(self):
+        read = planet.Channel(self.planet, 'Records URL')
+        records = cache.read_records(read._cache.filename)
+        loaded = planet.Channel(self.planet, 'Records URL', records)
+        self.assertEqual(loaded.name, 'Records')
+        self.assertEqual(sorted(loaded._items.keys()),
+                         sorted(read._items.keys()))
+        for id_, item in read._items.items():
+            other = loaded.get_item(id_)
+            self.assertEqual(sorted(other.keys()), sorted(item.keys()))
+            for key in item.keys():
+                self.assertEqual(other[key], item[key])
+
+    def test_missing_cache(self):
+        self.assertEqual(cache.read_records(
+            os.path.join(self.planet.cache_directory, 'missing')), None)
+
+
+class TitlePlainTest(unittest.TestCase):
+    """
+    Test the title_plain kept with each item
+    """
+
+    def setUp(self):
+        self.planet = FakePlanet()
+        self.planet.cache_directory = tempfile.mkdtemp()
+        self.channel = planet.Channel(self.planet, 'Title URL')
+        self.item = planet.NewsItem(self.channel, 'item')
+
+    def tearDown(self):
+        shutil.rmtree(self.planet.cache_directory)
+
+    def test_follows_title(self):
+        self.item.title = 'A <em>title</em> &amp; more'
+        self.assertEqual(self.item.get('title_plain'), 'A title & more')
+        self.item.title = 'Another <b>title</b>'
+        self.assertEqual(self.item.get('title_plain'), 'Another title')
+
+    def test_cached(self):
+        self.channel.updated = time.gmtime(0)
+        self.item.title = 'A <em>title</em>'
+        self.assertEqual(self.item.get('title_plain'), 'A title')
+        self.item.cache_write()
+        item = planet.NewsItem(self.channel, 'item')
+        self.assertTrue(item.has_key('title_plain'))
+        self.assertEqual(item.get('title_plain'), 'A title')
+        info = planet.template_info(item, '%Y')
+        self.assertEqual(info['title_plain'], 'A title')
+        self.assertEqual(info['title'], 'A <em>title</em>')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+
+from planet import model
+
+
+class TemplateInfoTest(unittest.TestCase):
+    """
+    Test deferred values of TemplateInfo
+    """
+
+    def setUp(self):
+        self.calls = []
+        self.info = model.TemplateInfo(title="Title")
+        self.info.defer("content", self.compute, "content")
+
+    def compute(self, key):
+        self.calls.append(key)
+        return "computed " + key
+
+    def test_deferred_until_read(self):
+        self.assertTrue("content" in self.info)
+        self.assertTrue(self.info.has_key("content"))
+        self.assertEqual(sorted(self.info.keys()), ["content", "title"])
+        self.assertEqual(len(self.info), 2)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.info["content"], "computed content")
+        self.assertEqual(self.info.get("content"), "computed content")
+        self.assertEqual(self.calls, ["content"])
+
+    def test_missing(self):
+        self.assertRaises(KeyError, lambda: self.info["missing"])
+        self.assertEqual(self.info.get("missing", 1), 1)
+
+    def test_items_resolve(self):
+        self.assertEqual(sorted(self.info.items()),
+                         [("content", "computed content"), ("title", "Title")])
+
+    def test_pickle(self):
+        info = pickle.loads(pickle.dumps(self.info, 2))
+        self.assertEqual(info, {"content": "computed content", "title": "Title"})
+        self.assertTrue(isinstance(info, model.TemplateInfo))
+
+    def test_dates(self):
+        self.info.defer_date("date", 1400000000, "%Y-%m-%d")
+        self.assertEqual(sorted(self.info.keys()),
+                         ["content", "date", "date_822", "date_iso", "title"])
+        self.assertEqual(self.info["date"], "2014-05-13")
+        self.assertEqual(self.info["date_iso"], "2014-05-13T16:53:20+00:00")
+        del self.info["date_822"]
+        self.assertFalse("date_822" in self.info)
+
+    def test_pickle_keeps_dates_deferred(self):
+        self.info.defer_date("date", 1400000000, "%Y-%m-%d")
+        info = pickle.loads(pickle.dumps(self.info, 2))
+        self.assertFalse(dict.has_key(info, "date"))
+        self.assertEqual(info["date"], "2014-05-13")
+        self.assertEqual(info["content"], "computed content")
+
+    def test_chain(self):
+        channel = model.TemplateInfo(name="Channel", title="Channel title")
+        self.info.chain("channel_", channel)
+        self.info["channel_title"] = "Own title"
+        self.assertEqual(self.info["channel_name"], "Channel")
+        self.assertEqual(self.info["channel_title"], "Own title")
+        self.assertTrue("channel_name" in self.info)
+        self.assertFalse("channel_missing" in self.info)
+        self.assertFalse(dict.has_key(self.info, "channel_name"))
+        self.assertEqual(sorted(self.info.keys()),
+                         ["channel_name", "channel_title", "content", "title"])
+        channel["name"] = "Renamed"
+        self.assertEqual(self.info["channel_name"], "Renamed")
+        self.assertEqual(self.info.copy()["channel_name"], "Renamed")
+
+    def test_pickle_shares_chained(self):
+        channel = model.TemplateInfo(name="Channel")
+        self.info.chain("channel_", channel)
+        other = model.TemplateInfo()
+        other.chain("channel_", channel)
+        info, other, channel = pickle.loads(pickle.dumps(
+            (self.info, other, channel), 2))
+        channel["name"] = "Renamed"
+        self.assertEqual(info["channel_name"], "Renamed")
+        self.assertEqual(other["channel_name"], "Renamed")
+
+    def test_unicode_view(self):
+        self.info["name"] = "caf\xc3\xa9"
+        view = model.unicode_view(self.info)
+        self.assertEqual(view["name"], u"caf\xe9")
+        self.assertEqual(self.calls, [])
+        self.assertEqual(view["content"], u"computed content")
+
+    def test_unicode_lists_share_channels(self):
+        channel = model.TemplateInfo(name="caf\xc3\xa9")
+        self.info.chain("channel_", channel)
+        other = model.TemplateInfo()
+        other.chain("channel_", channel)
+        channels, items = model.unicode_lists([channel], [self.info, other])
+        self.assertEqual(items[0]["channel_name"], u"caf\xe9")
+        self.assertTrue(items[0]["channel_name"] is
+                        items[1]["channel_name"])
+        self.assertTrue(channels[0]["name"] is items[1]["channel_name"])
+        self.assertEqual(self.calls, [])
+
+
+class PlainTextTest(unittest.TestCase):
+    """
+    Test removing HTML from titles
+    """
+
+    def test_tags(self):
+        self.assertEqual(model.plain_text("Item <em>1</em><!-- > -->"),
+                         "Item 1")
+        self.assertEqual(model.plain_text("<a title='>'>a</a> < b"), "a < b")
+
+    def test_references(self):
+        self.assertEqual(model.plain_text("&lt;b&gt; &amp 1 &#233;&#x263a;"),
+                         "<b> & 1 \xc3\xa9\xe2\x98\xba")
+        self.assertEqual(model.plain_text("AT&T &bogus; &#0;"),
+                         "AT&T &bogus; &#0;")
+
+
+class SnapshotTest(unittest.TestCase):
+    """
+    Test saving and loading snapshots of the template model
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "snapshot")
+        info = model.TemplateInfo(title="Title")
+        info.defer("content", lambda: "Content")
+        self.lists = ([model.TemplateInfo(name="Channel")], [info])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        serial = model.save_snapshot(self.filename, "inputs", *self.lists,
+                                     state=["200"])
+        saved_serial, channels_list, items_list = model.load_snapshot(
+            self.filename, "inputs", ["200"])
+        self.assertEqual(saved_serial, serial)
+        self.assertEqual(channels_list[0]["name"], "Channel")
+        self.assertEqual(items_list[0]["content"], "Content")
+        self.assertTrue(isinstance(items_list[0], model.TemplateInfo))
+        self.assertNotEqual(model.load_snapshot(self.filename, "inputs"),
+                            None)
+
+    def test_unusable(self):
+        self.assertEqual(model.load_snapshot(self.filename, "inputs"), None)
+        model.save_snapshot(self.filename, "inputs", *self.lists,
+                            state=["200"])
+        self.assertEqual(model.load_snapshot(self.filename, "other"), None)
+        self.assertEqual(
+            model.load_snapshot(self.filename, "inputs", ["404"]), None)
+        model.save_snapshot(self.filename, "inputs", *self.lists,
+                            expires=time.time() - 1)
+        self.assertEqual(model.load_snapshot(self.filename, "inputs"), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
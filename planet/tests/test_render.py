@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+
+import ConfigParser
+import dbhash
+import gzip
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+import planet
+from planet import cache, htmltmpl, model, render
+
+
+class UsesTimeTest(unittest.TestCase):
+    """
+    Test telling whether templates show the time they were rendered at
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def uses_time(self, name, source):
+        template_file = os.path.join(self.directory, name)
+        with open(template_file, "w") as f:
+            f.write(source)
+        return render.uses_time(template_file)
+
+    def test_htmltmpl(self):
+        self.assertTrue(self.uses_time("a.xml.tmpl",
+            '<updated><TMPL_VAR date_iso></updated>'))
+        self.assertTrue(self.uses_time("b.xml.tmpl",
+            '<!-- TMPL_VAR NAME="date" -->'))
+        self.assertFalse(self.uses_time("c.xml.tmpl",
+            '<TMPL_LOOP Items><TMPL_VAR date_iso></TMPL_LOOP>'))
+        self.assertTrue(self.uses_time("d.xml.tmpl",
+            '<TMPL_LOOP Items><TMPL_VAR date GLOBAL="1"></TMPL_LOOP>'))
+        self.assertFalse(self.uses_time("e.xml.tmpl",
+            '<TMPL_VAR channel_updated_iso>'))
+
+    def test_jinja(self):
+        self.assertTrue(self.uses_time("a.html", 'Last update: {{ date }}'))
+        self.assertFalse(self.uses_time("b.html",
+            '{% for item in Items %}{{ item.date }}{% endfor %}'))
+        self.assertTrue(self.uses_time("c.html", '{% include "x.html" %}'))
+
+    def test_missing(self):
+        self.assertTrue(render.uses_time(
+            os.path.join(self.directory, "missing.html")))
+
+    def test_filters(self):
+        self.assertFalse(self.uses_time("a.xml",
+            '{{ name|escape_html }}'))
+        self.assertTrue(self.uses_time("b.xml",
+            '{{ date|escape_html }}'))
+        self.assertTrue(self.uses_time("c.xml", '{{ name|no_such_filter }}'))
+        self.assertTrue(self.uses_time("d.xml", '{% if %}'))
+
+
+
+class HtmltmplTest(unittest.TestCase):
+    """
+    Test variable lookups in nested htmltmpl loops
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def prepare(self, source, precompile=0):
+        template_file = os.path.join(self.directory, "test.tmpl")
+        with open(template_file, "w") as f:
+            f.write(source)
+        return htmltmpl.TemplateManager(precompile=precompile).prepare(
+            template_file)
+
+    def process(self, source, global_vars=0, html_escape=0, **values):
+        """Process source both compiled and interpreted, which must agree."""
+        template = self.prepare(source)
+        self.assertNotEqual(template.function(), None)
+        results = []
+        for method in "generate", "interpret":
+            processor = htmltmpl.TemplateProcessor(html_escape=html_escape,
+                                                   global_vars=global_vars)
+            for key, value in values.items():
+                processor.set(key, value)
+            results.append("".join(getattr(processor, method)(template)))
+        self.assertEqual(results[0], results[1])
+        return results[0]
+
+    def test_nested_loops(self):
+        source = ('<TMPL_LOOP Outer><TMPL_VAR name>:<TMPL_VAR Inner>'
+                  '<TMPL_LOOP Inner>(<TMPL_VAR x><TMPL_VAR name>'
+                  '<TMPL_VAR top GLOBAL="1">)</TMPL_LOOP>;</TMPL_LOOP>'
+                  '<TMPL_LOOP Empty><TMPL_LOOP Sub>s</TMPL_LOOP></TMPL_LOOP>')
+        outer = [{"name": "a", "Inner": [{"x": "1"}, {"x": "2"}]},
+                 {"name": "b", "top": "B", "Inner": []},
+                 {"Inner": [{"x": "3", "name": "c"}]}]
+        self.assertEqual(self.process(source, top="T", Outer=outer, Empty=[]),
+                         "a:2(1T)(2T);b:0;:1(3cT);")
+        self.assertEqual(self.process(source, 1, top="T", Outer=outer,
+                                      Empty=[]),
+                         "a:2(1aT)(2aT);b:0;:1(3cT);")
+
+    def test_statements(self):
+        source = ('<TMPL_LOOP Items><TMPL_UNLESS __FIRST__>,</TMPL_UNLESS>'
+                  '<TMPL_VAR x><TMPL_VAR x ESCAPE="URL">'
+                  '<TMPL_VAR x ESCAPE="NONE"><TMPL_IF __LAST__>.</TMPL_IF>'
+                  '<TMPL_IF Sub><TMPL_VAR Sub><TMPL_ELSE>-</TMPL_IF>'
+                  '</TMPL_LOOP><TMPL_UNLESS Items>none</TMPL_UNLESS>')
+        items = [{"x": "a&b", "Sub": [{}]}, {"x": 1}, {"x": 2.5}]
+        self.assertEqual(self.process(source, Items=items),
+                         "a&ba%26ba&b1,111-,2.52.52.5.-")
+        self.assertEqual(self.process(source, html_escape=1, Items=items),
+                         "a&amp;ba%26ba&b1,111-,2.52.52.5.-")
+        self.assertEqual(self.process(source, Items=[]), "none")
+
+    def test_uncompiled(self):
+        # Multipart templates and misnested statements are interpreted
+        for source in ('a<TMPL_BOUNDARY>b',
+                       '<TMPL_LOOP Items><TMPL_IF x></TMPL_LOOP></TMPL_IF>',
+                       '<TMPL_LOOP Items><TMPL_ELSE></TMPL_LOOP>'):
+            self.assertEqual(self.prepare(source).function(), None)
+        processor = htmltmpl.TemplateProcessor()
+        self.assertEqual(processor.process(self.prepare('a<TMPL_BOUNDARY>b')),
+                         "ab")
+
+    def test_precompiled_function(self):
+        template = self.prepare('<TMPL_LOOP Items><TMPL_VAR x></TMPL_LOOP>',
+                                precompile=1)
+        self.assertTrue(os.path.exists(template.file() + "c"))
+        # Loaded with the function it was compiled to
+        template = htmltmpl.TemplateManager().prepare(template.file())
+        processor = htmltmpl.TemplateProcessor()
+        processor.set("Items", [{"x": "a"}, {"x": "b"}])
+        self.assertEqual(list(processor.generate(template)), ["a", "b", ""])
+
+    def test_precompile_dir(self):
+        precompile_dir = os.path.join(self.directory, "compiled")
+        os.mkdir(precompile_dir)
+        template_file = os.path.join(self.directory, "test.tmpl")
+        with open(template_file, "w") as f:
+            f.write('<TMPL_VAR x>')
+        manager = htmltmpl.TemplateManager(precompile_dir=precompile_dir)
+        template = manager.prepare(template_file)
+        self.assertFalse(os.path.exists(template_file + "c"))
+        self.assertEqual(len(os.listdir(precompile_dir)), 1)
+        # Kept in memory until the template changes
+        self.assertTrue(manager.prepare(template_file) is template)
+        os.utime(template_file, (0, 0))
+        self.assertFalse(manager.prepare(template_file) is template)
+
+
+class RenderJinjaTest(unittest.TestCase):
+    """
+    Test rendering Jinja templates through the shared environment
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.compiled = os.path.join(self.directory, "compiled")
+        os.mkdir(os.path.join(self.directory, "parts"))
+        self.write("index.html",
+                   '{% include "item.html" %}{{ Items|length }}')
+        self.write("parts/item.html", '{{ name }}:')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, source):
+        with open(os.path.join(self.directory, name), "w") as f:
+            f.write(source)
+
+    def render(self):
+        return u"".join(render.render_jinja(
+            os.path.join(self.directory, "index.html"),
+            {"name": "Planet", "Items": [{}], "Channels": []},
+            [os.path.join(self.directory, "parts")], self.compiled))
+
+    def test_include(self):
+        self.assertEqual(self.render(), "Planet:1")
+        self.assertTrue(os.listdir(self.compiled))
+
+    def test_shared(self):
+        self.render()
+        search_path = [self.directory, os.path.join(self.directory, "parts")]
+        env = render.jinja_environment(search_path, self.compiled)
+        self.assertTrue(env is render.jinja_environment(search_path,
+                                                        self.compiled))
+        self.assertTrue(env.bytecode_cache is not None)
+
+
+    def test_failure_is_logged(self):
+        self.write("bad.html", "{{ 1/0 }}")
+        output_dir = os.path.join(self.directory, "output")
+        os.mkdir(output_dir)
+        logging.disable(logging.ERROR)
+        try:
+            ok = render.try_render_template(
+                os.path.join(self.directory, "bad.html"), output_dir,
+                "%Y", "utf-8", [], [], {"link": "", "feed": ""})
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertFalse(ok)
+        self.assertEqual(os.listdir(output_dir), [])
+
+
+
+def without_times(output):
+    """Return output with the times the feeds were rendered at replaced."""
+    return re.sub(r"\d{4}-\d\d-\d\dT[\d:]{8}\+00:00|"
+                  r"\w{3}, \d\d \w{3} \d{4} [\d:]{8} \+0000",
+                  "NOW", output)
+
+
+class BundledFeedsTest(unittest.TestCase):
+    """
+    Test that the Jinja feed templates render like the htmltmpl ones
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.templates = os.path.join(os.path.dirname(render.__file__),
+                                      "templates")
+        channel = model.TemplateInfo(
+            name="Chan & 'co'", url="http://c/feed?a=1&b=2", link="http://c/",
+            title="The \xc3\xa9 <chan>", title_plain="The \xc3\xa9 chan",
+            language="fr", author_name="Chan Author")
+        self.items = []
+        for i, extra in enumerate([{},
+                                   {"author_email": "a@b", "content": "",
+                                    "title_language": "de"},
+                                   {"author_name": "", "title": ""}]):
+            info = model.TemplateInfo(
+                id="http://c/%d" % i, link="http://c/%d?x&y" % i,
+                title="T <b>%d</b> \"'" % i, title_plain="T %d \"'" % i,
+                content="<p>\xc3\xa9 & %d</p>" % i, author_name="Au",
+                date_iso="2014-05-13T16:53:20+00:00",
+                date_822="Tue, 13 May 2014 16:53:20 +0000")
+            info.update(extra)
+            info.chain("channel_", channel)
+            self.items.append(info)
+        self.channels = [channel]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def render(self, template_file, channels, items):
+        output_dir = tempfile.mkdtemp(dir=self.directory)
+        planet_kwargs = {"name": "Planet \xc3\xa9", "link": "http://p/?a&b",
+                         "feed": "http://p/atom.xml", "owner_name": "O",
+                         "owner_email": "o@p"}
+        render.render_template(
+            os.path.join(self.templates, template_file), output_dir,
+            "%B %d, %Y", "utf-8", channels, items, planet_kwargs, (),
+            os.path.join(self.directory, "compiled"))
+        with open(os.path.join(output_dir,
+                               render.output_name(template_file))) as f:
+            output = f.read()
+        return without_times(output)
+
+    def test_same_output(self):
+        for name in sorted(os.listdir(self.templates)):
+            if name.endswith(".tmpl"):
+                for channels, items in (self.channels, self.items), ([], []):
+                    self.assertEqual(
+                        self.render(os.path.splitext(name)[0], channels, items),
+                        self.render(name, channels, items))
+
+
+class GenerateAllFilesTest(unittest.TestCase):
+    """
+    Test rendering the templates of a planet, run after run
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.templates = os.path.join(os.path.dirname(render.__file__),
+                                      "templates")
+        self.output_dir = os.path.join(self.directory, "output")
+        os.mkdir(self.output_dir)
+        self.config = ConfigParser.ConfigParser()
+        self.config.add_section("Planet")
+        self.config.set("Planet", "name", "Planet")
+        self.config.set("Planet", "link", "http://p/")
+        self.config.set("Planet", "feed", "http://p/atom.xml")
+        self.config.set("Planet", "output_dir", self.output_dir)
+        self.config.set("Planet", "cache_directory",
+                        os.path.join(self.directory, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def generate(self, template_files):
+        my_planet = planet.Planet(self.config)
+        my_planet.run("Planet", "http://p/", template_files,
+                      render_only=True)
+        my_planet.generate_all_files(template_files,
+                                     dict(self.config.items("Planet")))
+
+    def test_bundled_templates(self):
+        template_files = [os.path.join(self.templates, name)
+                          for name in sorted(os.listdir(self.templates))]
+        self.generate(template_files)
+        outputs = sorted(os.listdir(self.output_dir))
+        self.assertEqual(outputs, sorted(set(
+            render.output_name(name) for name in template_files)))
+        self.generate(template_files)
+        self.assertEqual(sorted(os.listdir(self.output_dir)), outputs)
+
+    def add_channel(self, url, titles):
+        """Subscribe to url, with a cache holding items with titles."""
+        self.config.add_section(url)
+        my_planet = planet.Planet(self.config)
+        my_planet.configure_cache()
+        channel = planet.Channel(my_planet, url)
+        channel.name = "Channel"
+        for i, title in enumerate(titles):
+            item = planet.NewsItem(channel, "%s/%d" % (url, i))
+            item.title = title
+            item.set_as_date("date", time.gmtime(1400000000 - i * 3600))
+            item.order = str(i)
+            channel._items[item.id] = item
+        channel.cache_write()
+        channel._cache.close()
+        return cache.filename(my_planet.cache_directory, url)
+
+    def cached_keys(self, filename, key):
+        cache_file = dbhash.open(filename, "r")
+        try:
+            return sorted(k for k in cache_file.keys()
+                          if k.endswith(" " + key))
+        finally:
+            cache_file.close()
+
+    def run_offline(self, template_files):
+        my_planet = planet.Planet(self.config)
+        my_planet.run("Planet", "http://p/", template_files, offline=True)
+        my_planet.generate_all_files(template_files,
+                                     dict(self.config.items("Planet")))
+        return my_planet
+
+    def test_derived_values_are_kept(self):
+        filename = self.add_channel("http://c/feed",
+                                    ["<b>One</b>", "Two &amp; three"])
+        template_files = [self.write_template(
+            "titles.html",
+            "{% for item in Items %}{{ item.title_plain }};{% endfor %}")]
+        self.assertEqual(self.cached_keys(filename, "title_plain"), [])
+        self.run_offline(template_files)
+        output_file = os.path.join(self.output_dir, "titles.html")
+        with open(output_file) as f:
+            self.assertEqual(f.read(), "One;Two & three;")
+        self.assertEqual(self.cached_keys(filename, "title_plain"),
+                         ["http://c/feed/0 title_plain",
+                          "http://c/feed/1 title_plain"])
+
+        # The snapshot saved is still usable
+        my_planet = planet.Planet(self.config)
+        my_planet.run("Planet", "http://p/", template_files,
+                      render_only=True)
+        my_planet.gather_model(template_files)
+        self.assertEqual(my_planet.channels(hidden=True), [])
+
+        # And without it the titles aren't stripped again
+        os.remove(os.path.join(self.config.get("Planet", "cache_directory"),
+                               planet.SNAPSHOT_FILENAME))
+        os.remove(output_file)
+        calls = []
+        plain_text = model.plain_text
+        def counting(html):
+            calls.append(html)
+            return plain_text(html)
+        model.plain_text = counting
+        try:
+            self.run_offline(template_files)
+        finally:
+            model.plain_text = plain_text
+        self.assertEqual(calls, [])
+        with open(output_file) as f:
+            self.assertEqual(f.read(), "One;Two & three;")
+
+    def test_changed_title(self):
+        filename = self.add_channel("http://c/feed", ["<b>One</b>"])
+        template_files = [self.write_template(
+            "titles.html",
+            "{% for item in Items %}{{ item.title_plain }};{% endfor %}")]
+        my_planet = self.run_offline(template_files)
+
+        # As if an update changed the title
+        channel = my_planet.channels(hidden=True)[0]
+        channel.get_item("http://c/feed/0").title = "<i>Uno</i>"
+        channel.cache_write()
+        channel._cache.close()
+        self.run_offline(template_files)
+        with open(os.path.join(self.output_dir, "titles.html")) as f:
+            self.assertEqual(f.read(), "Uno;")
+        cache_file = dbhash.open(filename, "r")
+        try:
+            self.assertTrue(
+                cache_file["http://c/feed/0 title_plain"].endswith(" Uno"))
+        finally:
+            cache_file.close()
+
+    def outputs(self):
+        outputs = {}
+        for name in os.listdir(self.output_dir):
+            with open(os.path.join(self.output_dir, name)) as f:
+                outputs[name] = without_times(f.read())
+        return outputs
+
+    @unittest.skipIf(planet.Pool is None, "no multiprocessing")
+    def test_parallel(self):
+        template_files = [os.path.join(self.templates, name)
+                          for name in sorted(os.listdir(self.templates))]
+        template_files.append(self.write_template("plain.txt.tmpl",
+                                                  "<TMPL_VAR name>"))
+        self.generate(template_files)
+        serial = self.outputs()
+
+        pools = []
+        Pool = planet.Pool
+        def pool(processes, *args):
+            pools.append(processes)
+            return Pool(processes, *args)
+        self.output_dir = os.path.join(self.directory, "parallel")
+        os.mkdir(self.output_dir)
+        self.config.set("Planet", "output_dir", self.output_dir)
+        self.config.set("Planet", "render_processes", "3")
+        planet.Pool = pool
+        try:
+            self.generate(template_files)
+        finally:
+            planet.Pool = Pool
+        self.assertEqual(pools, [3])
+        self.assertEqual(self.outputs(), serial)
+
+    def rendered(self, template_files):
+        """Return the names of the templates generate() renders."""
+        names = []
+        try_render_template = render.try_render_template
+        def record(template_file, *args):
+            names.append(os.path.basename(template_file))
+            return try_render_template(template_file, *args)
+        render.try_render_template = record
+        try:
+            self.generate(template_files)
+        finally:
+            render.try_render_template = try_render_template
+        return sorted(names)
+
+    def write_template(self, name, source):
+        template_file = os.path.join(self.directory, name)
+        with open(template_file, "w") as f:
+            f.write(source)
+        return template_file
+
+    def test_skip_unchanged(self):
+        template_files = [
+            self.write_template("plain.html", "{{ name }}"),
+            self.write_template("time.html", "{{ name }} {{ date }}"),
+            self.write_template("include.html", '{% include "plain.html" %}'),
+            self.write_template("plain.txt.tmpl", "<TMPL_VAR name>")]
+        everything = sorted(os.path.basename(f) for f in template_files)
+        self.assertEqual(self.rendered(template_files), everything)
+        self.assertEqual(self.rendered(template_files),
+                         ["include.html", "time.html"])
+
+        # Changed templates are rendered again
+        os.utime(template_files[0], (1000000000, 1000000000))
+        self.assertEqual(self.rendered(template_files),
+                         ["include.html", "plain.html", "time.html"])
+        self.assertEqual(self.rendered(template_files),
+                         ["include.html", "time.html"])
+
+        # So are missing outputs
+        os.remove(os.path.join(self.output_dir, "plain.txt"))
+        self.assertEqual(self.rendered(template_files),
+                         ["include.html", "plain.txt.tmpl", "time.html"])
+
+        # And all of them when the model changes
+        self.config.set("Planet", "name", "Another planet")
+        self.assertEqual(self.rendered(template_files), everything)
+        with open(os.path.join(self.output_dir, "plain.html")) as f:
+            self.assertEqual(f.read(), "Another planet")
+
+
+class WriteOutputTest(unittest.TestCase):
+    """
+    Test writing rendered chunks in the configured encoding
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.directory, "index.html")
+        # A UTF-8 character split across chunks, and some unicode
+        self.chunks = ["caf\xc3", "\xa9 ", u"\u263a"]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def written(self, encoding):
+        render.write_output(self.output_file, iter(self.chunks), encoding)
+        with open(self.output_file) as f:
+            return f.read()
+
+    def test_encodings(self):
+        self.assertEqual(self.written("utf-8"), "caf\xc3\xa9 \xe2\x98\xba")
+        self.assertEqual(self.written("xml"), "caf&#233; &#9786;")
+        self.assertEqual(self.written("latin-1"), "caf\xe9 ?")
+        self.assertEqual(os.listdir(self.directory), ["index.html"])
+
+    def test_failure_keeps_old_output(self):
+        self.written("utf-8")
+        def chunks():
+            yield "partial"
+            raise ValueError
+        self.assertRaises(ValueError, render.write_output,
+                          self.output_file, chunks(), "utf-8")
+        self.assertEqual(os.listdir(self.directory), ["index.html"])
+        self.assertEqual(self.written("utf-8"), "caf\xc3\xa9 \xe2\x98\xba")
+
+    def test_mode_is_kept(self):
+        self.written("utf-8")
+        os.chmod(self.output_file, 0640)
+        self.written("xml")
+        self.assertEqual(os.stat(self.output_file).st_mode & 0777, 0640)
+
+    def test_unchanged_output_is_kept(self):
+        self.written("utf-8")
+        os.utime(self.output_file, (1000000000, 1000000000))
+        self.assertFalse(render.write_output(self.output_file,
+                                             iter(self.chunks), "utf-8"))
+        self.assertEqual(os.path.getmtime(self.output_file), 1000000000)
+        self.assertEqual(os.listdir(self.directory), ["index.html"])
+        self.assertTrue(render.write_output(self.output_file,
+                                            iter(self.chunks), "xml"))
+        self.assertNotEqual(os.path.getmtime(self.output_file), 1000000000)
+
+
+
+class CompressOutputTest(unittest.TestCase):
+    """
+    Test keeping compressed copies of outputs
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.directory, "index.html")
+        self.content = "<p>content</p>\n" * 1000
+        render.write_output(self.output_file, [self.content], "utf-8")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_compress(self):
+        brotli_file = self.output_file + ".br"
+        if render.brotli is None:
+            # A copy of an older output
+            with open(brotli_file, "w") as f:
+                f.write("stale")
+        render.compress_output(self.output_file)
+        gzip_file = self.output_file + ".gz"
+        self.assertEqual(gzip.open(gzip_file).read(), self.content)
+        self.assertEqual(int(os.path.getmtime(gzip_file)),
+                         int(os.path.getmtime(self.output_file)))
+        self.assertEqual(os.path.exists(brotli_file),
+                         render.brotli is not None)
+
+        # Unchanged outputs keep their copies
+        os.utime(gzip_file, (0, 0))
+        render.compress_output(self.output_file, False)
+        self.assertEqual(os.path.getmtime(gzip_file), 0)
+        render.compress_output(self.output_file, True)
+        self.assertNotEqual(os.path.getmtime(gzip_file), 0)
+
+    def test_mode(self):
+        os.chmod(self.output_file, 0640)
+        render.compress_output(self.output_file)
+        for extension in ".gz", ".br":
+            if os.path.exists(self.output_file + extension):
+                self.assertEqual(
+                    os.stat(self.output_file + extension).st_mode & 0777, 0640)
+
+
+if __name__ == '__main__':
+    unittest.main()